@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for main.py.
+
+Run from the repository folder:
+    python benchmark.py                      # FX lookup, decimal formatting, XML serialization
+    python benchmark.py --stages             # main.py stage by stage at 1k/100k/1M rows -> benchmark.json
+    python benchmark.py --generate synthetic --rows 50000 --currencies USD,GBX
+
+Correctness of the fast paths is checked separately: python check.py
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from decimal import Decimal
+from typing import Sequence
+from xml.dom import minidom
+from xml.etree.ElementTree import Element, SubElement, tostring
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import main
+
+
+# =========================
+# HELPERS
+# =========================
+def timed(func, *args) -> tuple[float, object]:
+    """Run func(*args) and return (seconds, result)."""
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def synthetic_dates(count: int, first: datetime.date, last: datetime.date, seed: int = 1) -> list[str]:
+    """Random transaction dates (including weekends and holidays) between first and last."""
+    rnd = random.Random(seed)
+    span = (last - first).days
+    return [(first + datetime.timedelta(days=rnd.randint(0, span))).isoformat() for _ in range(count)]
+
+
+def peak_rss_mb() -> float | None:
+    """Peak resident memory of this process in MB (None where not available)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# =========================
+# SYNTHETIC EXPORTS
+# =========================
+# Trading 212 header layouts: "legacy" (no order ID, base currency in "Result (EUR)"),
+# "current" (order ID, base currency in "Currency (Result)" / "Currency (Total)")
+HEADERS = {
+    "legacy": [
+        "Action", "Time", "ISIN", "Ticker", "Name", "No. of shares", "Price / share", "Currency (Price / share)",
+        "Exchange rate", "Result ({base})", "Total ({base})", "Withholding tax", "Currency (Withholding tax)",
+    ],
+    "current": [
+        "Action", "Time", "ISIN", "Ticker", "Name", "Notes", "ID", "No. of shares", "Price / share",
+        "Currency (Price / share)", "Exchange rate", "Result", "Currency (Result)", "Total", "Currency (Total)",
+        "Withholding tax", "Currency (Withholding tax)",
+    ],
+}
+
+# Share of each action in generated rows (buys, sells, and rows main.py skips)
+ACTION_WEIGHTS = {
+    "Market buy": 40, "Limit buy": 12, "Market sell": 20, "Limit sell": 8, "Stop sell": 2,
+    "Dividend (Ordinary)": 10, "Deposit": 6, "Interest on cash": 2,
+}
+
+# Rough units of each currency per EUR (Trading 212 "Exchange rate" column is quote per base)
+PER_EUR = {"EUR": 1.0, "USD": 1.09, "GBP": 0.86, "GBX": 86.0, "CHF": 0.95}
+
+
+def write_synthetic_exports(
+    folder: str,
+    rows: int,
+    tickers: int = 50,
+    currencies: Sequence[str] = ("USD", "EUR", "GBP", "GBX"),
+    header: str = "current",
+    base_currency: str = "EUR",
+    years: Sequence[int] = (2023, 2024),
+    seed: int = 1,
+) -> list[str]:
+    """
+    Write Trading 212-like CSV exports (one file per year, sorted by time) with
+    rows rows in total and return the file names. Tickers are quoted in the
+    given currencies round-robin; trade times include weekends and holidays.
+    """
+    for currency in (*currencies, base_currency):
+        if currency not in PER_EUR:
+            raise ValueError(f"Unsupported currency: {currency}")
+
+    rnd = random.Random(seed)
+    names = [f"T{i:03d}" for i in range(tickers)]
+    quoted = {ticker: currencies[i % len(currencies)] for i, ticker in enumerate(names)}
+    actions = list(ACTION_WEIGHTS)
+    weights = list(ACTION_WEIGHTS.values())
+    isin = {ticker: f"US{i:010d}" for i, ticker in enumerate(names)}
+    # Row values are looked up by the unformatted column name ("Result ({base})" -> "Result")
+    columns = [(c.format(base=base_currency), c.split(" ({base})")[0]) for c in HEADERS[header]]
+
+    filenames = []
+    order_id = 0
+    for index, year in enumerate(years):
+        count = rows // len(years) + (index < rows % len(years))
+        first = datetime.datetime(year, 1, 1)
+        span = int((datetime.datetime(year + 1, 1, 1) - first).total_seconds())
+        seconds = sorted(rnd.randrange(span) for _ in range(count))
+        filename = f"export_{year}.csv"
+        with open(os.path.join(folder, filename), "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(name for name, _ in columns)
+            for offset, action in zip(seconds, rnd.choices(actions, weights, k=count)):
+                ticker = rnd.choice(names)
+                currency = quoted[ticker]
+                time = (first + datetime.timedelta(seconds=offset)).strftime("%Y-%m-%d %H:%M:%S")
+                quantity = f"{rnd.uniform(0.01, 25):.{rnd.randint(2, 10)}f}"
+                price = f"{rnd.uniform(1, 800) * (100 if currency == 'GBX' else 1):.{rnd.randint(2, 4)}f}"
+                rate = PER_EUR[currency] / PER_EUR[base_currency] * rnd.uniform(0.97, 1.03)
+                total = float(quantity) * float(price) / rate
+                values = {
+                    "Action": action, "Time": time, "ISIN": isin[ticker], "Ticker": ticker, "Name": f"{ticker} Inc",
+                    "Notes": "", "ID": f"EOF{order_id}", "No. of shares": quantity, "Price / share": price,
+                    "Currency (Price / share)": currency,
+                    "Exchange rate": "1.00" if currency == base_currency else f"{rate:.{rnd.randint(4, 8)}f}",
+                    "Result": f"{rnd.uniform(-50, 50):.2f}" if action.endswith("sell") else "",
+                    "Currency (Result)": base_currency, "Total": f"{total:.2f}", "Currency (Total)": base_currency,
+                    "Withholding tax": "", "Currency (Withholding tax)": "",
+                }
+                if action.startswith("Dividend"):
+                    values["Withholding tax"] = f"{total * 0.15:.2f}"
+                    values["Currency (Withholding tax)"] = currency
+                elif action in ("Deposit", "Interest on cash"):
+                    for column in ("ISIN", "Ticker", "Name", "No. of shares", "Price / share",
+                                   "Currency (Price / share)", "Exchange rate"):
+                        values[column] = ""
+                writer.writerow(values[key] for _, key in columns)
+                order_id += 1
+        filenames.append(filename)
+    return filenames
+
+
+# =========================
+# FX LOOKUP
+# =========================
+def legacy_find_usd_eur_rate(date: str, usd_eur: dict) -> Decimal:
+    """Previous implementation: search backwards day by day, convert on every hit."""
+    dt = date
+    while dt not in usd_eur:
+        dt_dt = datetime.datetime.strptime(dt, "%Y-%m-%d") - datetime.timedelta(days=1)
+        dt = dt_dt.strftime("%Y-%m-%d")
+    return main.to_decimal(usd_eur[dt])
+
+
+def bench_fx_lookup(count: int) -> None:
+    """Compare per-lookup cost of the day-by-day search, the indexed RateTable and the mmap cache."""
+    rates: dict[str, dict] = {}
+    pair_rates: dict[str, dict] = {}
+    for filename in sorted(f for f in main.get_files(main.RATE_FOLDER) if f.lower().endswith(".csv")):
+        main.read_rate_file(filename, main.RATE_FOLDER, rates, pair_rates)
+    rates.update(pair_rates)
+    raw = rates["USD"]["days"]
+
+    build_time, table = timed(main.build_rate_table, "USD", raw, rates["USD"]["per_eur"])
+    first = datetime.date.fromisoformat(min(raw))
+    last = datetime.date.fromisoformat(max(raw))
+    dates = synthetic_dates(count, first, last)
+
+    state: dict = {}
+    main.load_rates(main.RATE_FOLDER, state)  # make sure the cache exists
+    cache_time, _ = timed(main.load_rates, main.RATE_FOLDER, state)
+    cached = main.get_rate_table(state["rates"], "USD")
+
+    legacy_time, legacy = timed(lambda: [legacy_find_usd_eur_rate(d, raw) for d in dates])
+    table_time, indexed = timed(lambda: [main.find_rate(d, table) for d in dates])
+    cached_time, from_cache = timed(lambda: [main.find_rate(d, cached) for d in dates])
+
+    if legacy != indexed or legacy != from_cache:
+        raise AssertionError("RateTable lookups differ from the day-by-day search")
+
+    print(f"FX lookup ({count} transactions, rates {first} - {last})")
+    print(f"  build table:     {build_time * 1000:10.2f} ms")
+    print(f"  load from cache: {cache_time * 1000:10.2f} ms")
+    print(f"  backward search: {legacy_time / count * 1e6:10.3f} us/lookup")
+    print(f"  indexed table:   {table_time / count * 1e6:10.3f} us/lookup")
+    print(f"  mmap cache:      {cached_time / count * 1e6:10.3f} us/lookup")
+
+
+# =========================
+# DECIMAL FORMATTING
+# =========================
+EDGE_VALUES = [
+    "0", "-0", "0.000000005", "0.000000004999", "1.2827944384", "1.999999995", "10", "10.00000000",
+    "123456789012.123456785", "0.1", "1E+2", "1e-9", "  42.5  ", "00012.3400", "+3.5", ".5",
+]
+
+
+def synthetic_numbers(count: int, seed: int = 1) -> list[str]:
+    """Quantities / prices as Trading 212 exports them (2 to 10 decimals)."""
+    rnd = random.Random(seed)
+    return [f"{rnd.uniform(0, 5000):.{rnd.randint(2, 10)}f}" for _ in range(count)] + EDGE_VALUES
+
+
+def bench_decimal_format(count: int) -> None:
+    """Compare per-value fmt_decimal with the fixed-point column conversion (checked by check.py)."""
+    values = synthetic_numbers(count)
+
+    decimal_time, expected = timed(lambda: [main.fmt_decimal(v, "typeDecimalPos12_8") for v in values])
+    column_time, column = timed(main.fmt_decimal_column, values, "typeDecimalPos12_8")
+    if column != expected:
+        raise AssertionError("fmt_decimal_column differs from fmt_decimal")
+
+    # Per value the column conversion is about as fast as fmt_decimal (it is still a
+    # Python loop per value). Per transaction the previous code formatted price and
+    # quantity 5 times (again in purchase/sale, and F8); now each is formatted once.
+    per_decimal = decimal_time / len(values) * 1e6
+    per_column = column_time / len(values) * 1e6
+    print(f"Decimal formatting ({len(values)} values, same output as fmt_decimal)")
+    print(f"  per value:       fmt_decimal {per_decimal:8.3f} us, fmt_decimal_column {per_column:8.3f} us")
+    print(f"  per transaction: 2 values {2 * per_decimal:8.3f} us -> {2 * per_column:.3f} us (like for like)")
+    print(f"  per transaction: 5 fmt_decimal calls (previous code) {5 * per_decimal:8.3f} us -> 2 values {2 * per_column:.3f} us")
+    print("  (the per-transaction gain comes from not formatting the same values again, not from batching)")
+
+
+# =========================
+# XML SERIALIZATION
+# =========================
+def build_synthetic_tree(count: int) -> Element:
+    """Doh_KDVP envelope with count transactions (same builders as main.py)."""
+    envelope = Element("Envelope", {
+        "xmlns": "http://edavki.durs.si/Documents/Schemas/Doh_KDVP_9.xsd",
+        "xmlns:edp": "http://edavki.durs.si/Documents/Schemas/EDP-Common-1.xsd",
+    })
+    body = SubElement(envelope, "body")
+    doh = SubElement(body, "Doh_KDVP")
+    rnd = random.Random(1)
+    for i in range(count):
+        item = main.KVDP_item(doh, f"T{i % 500}")
+        quantity = main.fmt_decimal(f"{rnd.uniform(0.01, 50):.10f}", "typeDecimalPos12_8")
+        price = main.fmt_decimal(f"{rnd.uniform(1, 500):.10f}", "typeDecimalPos14_8")
+        if i % 3:
+            main.purchase(item, "2024-01-02", quantity, price)
+        else:
+            main.sale(item, "2024-01-02", quantity, price)
+        SubElement(item, "F8").text = "0"
+    return envelope
+
+
+def legacy_save(elem, path: str) -> None:
+    """Previous implementation: tostring -> minidom.parseString -> toprettyxml -> write."""
+    xml_output = minidom.parseString(tostring(elem, "utf-8")).toprettyxml(indent="  ")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(xml_output)
+
+
+def run_serialize_variant(variant: str, count: int) -> None:
+    """Serialize one synthetic tree and print timing + peak RSS as JSON (runs in a child process)."""
+    envelope = build_synthetic_tree(count)
+    rss_tree = peak_rss_mb()
+    folder = tempfile.mkdtemp()
+    start = time.perf_counter()
+    if variant == "minidom":
+        legacy_save(envelope, os.path.join(folder, "output.xml"))
+        path = os.path.join(folder, "output.xml")
+    else:
+        path = main.save_file(main.prettify(envelope), folder, "output.xml")
+    seconds = time.perf_counter() - start
+    print(json.dumps({
+        "seconds": seconds,
+        "rss_tree_mb": rss_tree,
+        "rss_peak_mb": peak_rss_mb(),
+        "bytes": os.path.getsize(path),
+        "path": path,
+    }))
+
+
+def bench_serialize(count: int) -> None:
+    """Compare minidom pretty printing with the streaming writer (each in a fresh process)."""
+    results = {}
+    for variant in ("minidom", "stream"):
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--serialize-variant", variant, "--rows", str(count)],
+            check=True, capture_output=True, text=True,
+        )
+        results[variant] = json.loads(out.stdout.strip().splitlines()[-1])
+
+    with open(results["minidom"]["path"], "rb") as a, open(results["stream"]["path"], "rb") as b:
+        same = a.read() == b.read()
+    for r in results.values():
+        os.remove(r["path"])
+        os.rmdir(os.path.dirname(r["path"]))
+    if not same:
+        raise AssertionError("Streaming writer output differs from minidom output")
+
+    print(f"XML serialization ({count} transactions, {results['stream']['bytes'] / 1e6:.1f} MB output)")
+    for variant, r in results.items():
+        rss = "n/a" if r["rss_peak_mb"] is None else f"{r['rss_peak_mb']:.1f} MB (tree only: {r['rss_tree_mb']:.1f} MB)"
+        print(f"  {variant:8s} {r['seconds']:8.2f} s   peak RSS {rss}")
+
+
+# =========================
+# STAGES
+# =========================
+# Row counts of the staged benchmark (--stages)
+STAGE_SIZES = (1_000, 100_000, 1_000_000)
+
+
+def measure(stages: dict, name: str, func, *args):
+    """Run one stage, store its time, peak RSS and (with tracemalloc on) peak traced memory."""
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    seconds, result = timed(func, *args)
+    stages[name] = {"seconds": round(seconds, 6), "rss_peak_mb": peak_rss_mb()}
+    if tracemalloc.is_tracing():
+        stages[name]["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    return result
+
+
+def drain(iterator, func=None) -> int:
+    """Consume an iterator (calling func on each item) and return the item count."""
+    count = 0
+    for item in iterator:
+        if func is not None:
+            func(item)
+        count += 1
+    return count
+
+
+def run_stages(folder: str, year: str) -> dict:
+    """
+    Run main.py stage by stage on the CSV files in folder (runs in a child process):
+    fx_load (rate CSV -> tables, cache written), fx_load_cached, load (scan pass and
+    parsing every row into Transaction records), eur_price (load + EUR conversion),
+    trades_export / trades_import (columnar trades file written and read back), xml_build, rounding_fix (XML build with --fix-rounding-error, computed in the
+    same pass) and serialize (streamed pretty XML written to a file).
+    RSS is a high-water mark, so a stage only shows up when it raises the peak.
+    """
+    stages: dict = {}
+    state = main.new_state(main.settings_taxpayer(), year, main.Options())
+    cache_folder = os.path.join(folder, "rate_cache")
+    measure(stages, "fx_load", main.load_rates, main.RATE_FOLDER, state, cache_folder, False)
+    measure(stages, "fx_load_cached", main.load_rates, main.RATE_FOLDER, state, cache_folder, False)
+
+    def load() -> int:
+        main.load_input_files(folder, state)
+        return drain(main.iter_transactions(state))
+
+    rows = measure(stages, "load", load)
+    measure(stages, "eur_price", lambda: drain(main.iter_transactions(state), lambda tx: main.eur_price_units(tx, state)))
+
+    trades_path = os.path.join(folder, "trades.bin")
+
+    def export_trades() -> None:
+        state["trades_export"] = main.new_trade_columns()
+        drain(main.iter_transactions(state))
+        main.write_trades_file(trades_path, state["trades_export"])
+        state["trades_export"] = None
+
+    def import_trades() -> int:
+        imported = main.new_state(main.settings_taxpayer(), year, main.Options())
+        imported["rates"] = state["rates"]
+        main.load_trades_file(trades_path, imported)
+        return drain(main.iter_transactions(imported))
+
+    measure(stages, "trades_export", export_trades)
+    if measure(stages, "trades_import", import_trades) != rows:
+        raise AssertionError("Trades file does not hold every transaction")
+
+    envelope, count, _ = measure(stages, "xml_build", main.process_transactions, state)
+    del envelope
+    envelope, _, adjustments = measure(
+        stages, "rounding_fix", main.process_transactions, dict(state, fix_rounding_error=True)
+    )
+    path = measure(stages, "serialize", lambda: main.save_file(main.prettify(envelope), folder, "output.xml"))
+    return {
+        "transactions": rows,
+        "xml_transactions": count,
+        "rounding_adjustments": len(adjustments),
+        "tickers_with_sell": len(state["tickers_with_sell"]),
+        "xml_bytes": os.path.getsize(path),
+        "trades_bytes": os.path.getsize(trades_path),
+        "stages": stages,
+    }
+
+
+def bench_stages(sizes: Sequence[int], output: str, trace_memory: bool, generator: dict) -> None:
+    """
+    Generate synthetic exports for every size and run the stages in a fresh
+    process each; print a table and write all results to output (JSON).
+    """
+    results = []
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            seconds, filenames = timed(lambda: write_synthetic_exports(folder, rows, **generator))
+            command = [sys.executable, os.path.abspath(__file__), "--stage-run", folder,
+                       "--year", str(generator["years"][-1])]
+            if trace_memory:
+                command.append("--trace-memory")
+            out = subprocess.run(command, check=True, capture_output=True, text=True)
+            result = {
+                "rows": rows,
+                "csv_bytes": sum(os.path.getsize(os.path.join(folder, f)) for f in filenames),
+                "generate_seconds": round(seconds, 6),
+                **json.loads(out.stdout.strip().splitlines()[-1]),
+            }
+        results.append(result)
+
+        print(f"Stages ({rows} rows, {result['transactions']} transactions, {result['csv_bytes'] / 1e6:.1f} MB CSV)")
+        for name, stage in result["stages"].items():
+            rss = "n/a" if stage["rss_peak_mb"] is None else f"{stage['rss_peak_mb']:.1f} MB"
+            traced = f"   traced peak {stage['traced_peak_mb']:.1f} MB" if "traced_peak_mb" in stage else ""
+            print(f"  {name:15s} {stage['seconds']:9.3f} s   peak RSS {rss}{traced}")
+
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "trace_memory": trace_memory,
+        "generator": generator,
+        "results": results,
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print("Results saved to:", output)
+
+
+# =========================
+# CLI
+# =========================
+def parse_args():
+    """Parse CLI arguments."""
+    parser = argparse.ArgumentParser(description="Benchmark main.py stages.")
+    parser.add_argument("--rows", type=int, default=100_000, help="Number of synthetic transactions (CSV rows).")
+    parser.add_argument(
+        "--stages",
+        action="store_true",
+        help="Time load, FX load, rounding fix, XML build and serialization of main.py on synthetic exports.",
+    )
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(size) for size in STAGE_SIZES),
+        help="Comma separated row counts for --stages.",
+    )
+    parser.add_argument("--output", default="benchmark.json", help="JSON file for --stages results.")
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Also record peak Python allocations per stage with tracemalloc (much slower).",
+    )
+    parser.add_argument("--generate", metavar="FOLDER", help="Only write synthetic Trading 212 exports into FOLDER.")
+    parser.add_argument("--tickers", type=int, default=50, help="Number of synthetic tickers.")
+    parser.add_argument("--currencies", default="USD,EUR,GBP,GBX", help="Quote currencies of the tickers.")
+    parser.add_argument("--header", choices=sorted(HEADERS), default="current", help="Trading 212 header layout.")
+    parser.add_argument("--base-currency", default="EUR", help="Export base currency.")
+    parser.add_argument("--years", default="2023,2024", help="Years of the exports (one file per year).")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed of the generator.")
+    parser.add_argument("--serialize-variant", choices=["minidom", "stream"], help=argparse.SUPPRESS)
+    parser.add_argument("--stage-run", metavar="FOLDER", help=argparse.SUPPRESS)
+    parser.add_argument("--year", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    if args.serialize_variant:
+        run_serialize_variant(args.serialize_variant, args.rows)
+        return
+    if args.stage_run:
+        if args.trace_memory:
+            tracemalloc.start()
+        print(json.dumps(run_stages(args.stage_run, args.year)))
+        return
+
+    generator = {
+        "tickers": args.tickers,
+        "currencies": args.currencies.split(","),
+        "header": args.header,
+        "base_currency": args.base_currency,
+        "years": [int(year) for year in args.years.split(",")],
+        "seed": args.seed,
+    }
+    if args.generate:
+        os.makedirs(args.generate, exist_ok=True)
+        for filename in write_synthetic_exports(args.generate, args.rows, **generator):
+            print("Written:", os.path.join(args.generate, filename))
+        return
+    if args.stages:
+        bench_stages([int(size) for size in args.sizes.split(",")], args.output, args.trace_memory, generator)
+        return
+    bench_fx_lookup(args.rows)
+    bench_decimal_format(args.rows)
+    bench_serialize(args.rows)
+
+
+if __name__ == "__main__":
+    run()
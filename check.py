@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Correctness checks of the fixed-point fast paths in main.py (against the Decimal code).
+
+Run from the repository folder (uses the rate files in the rate folder):
+    python check.py
+    python check.py --rows 200000
+"""
+import argparse
+import datetime
+import random
+from decimal import Decimal
+
+import main
+from benchmark import synthetic_dates, synthetic_numbers
+
+
+# =========================
+# CHECKS
+# =========================
+def check_fast_decimal(values: list[str]) -> None:
+    """Fixed-point column formatting must match fmt_decimal for every value and XSD type."""
+    for xsd_type, rule in main.DECIMAL_RULES.items():
+        column = [v for v in values if rule["allow_negative"] or not v.strip().startswith("-")]
+        expected = [main.fmt_decimal(v, xsd_type) for v in column]
+        if main.fmt_decimal_column(column, xsd_type) != expected:
+            raise AssertionError(f"fmt_decimal_column differs from fmt_decimal for {xsd_type}")
+        negative = [f"-{v}" for v in column[:100] if main.to_decimal(v) != 0]
+        for v in negative:
+            for func in (lambda: main.fmt_decimal(v, xsd_type), lambda: main.fmt_decimal_column([v], xsd_type)):
+                try:
+                    func()
+                    allowed = True
+                except ValueError:
+                    allowed = False
+                if allowed != rule["allow_negative"]:
+                    raise AssertionError(f"Negative check differs for {xsd_type}: {v}")
+    try:
+        main.fmt_decimal_column(["1234567890123.5"], "typeDecimalPos12_8")
+    except ValueError as e:
+        if "Too many digits" not in str(e):
+            raise
+    else:
+        raise AssertionError("fmt_decimal_column accepted too many int digits")
+
+
+def check_fast_eur_price(count: int) -> None:
+    """eur_price_units must match fmt_decimal(compute_eur_unit_price(...)) for EUR/USD/GBP/GBX rows."""
+    state: dict = {}
+    main.load_rates(main.RATE_FOLDER, state)
+    table = main.get_rate_table(state["rates"], "USD")
+    first = datetime.date.fromordinal(table.first_ordinal)
+    last = datetime.date.fromordinal(table.first_ordinal + len(table.values) - 1)
+    rnd = random.Random(2)
+    for i, (date, price) in enumerate(zip(synthetic_dates(count, first, last), synthetic_numbers(count))):
+        if not main.parse_fixed(price.strip()) or price.strip().startswith("-"):
+            continue
+        currency = ("EUR", "USD", "USD", "GBP", "GBX")[i % 5]
+        tx = main.Transaction(
+            time=f"{date} 10:00:00", ticker="T", action="Market buy", side="buy",
+            quantity=Decimal("1"), price=main.to_decimal(price), currency=currency,
+            rate=Decimal(f"{rnd.uniform(0.5, 1.5):.5f}"), base_currency=("EUR", "USD")[i % 2],
+            source="bench.csv", line=i,
+        )
+        fast = main.fmt_units_column([main.eur_price_units(tx, state)], "typeDecimalPos14_8")[0]
+        if fast != main.fmt_decimal(main.compute_eur_unit_price(tx, state), "typeDecimalPos14_8"):
+            raise AssertionError(f"eur_price_units differs for {tx}")
+
+
+# =========================
+# CLI
+# =========================
+def run():
+    parser = argparse.ArgumentParser(description="Check main.py fast paths against the Decimal code.")
+    parser.add_argument("--rows", type=int, default=20_000, help="Number of synthetic values per check.")
+    args = parser.parse_args()
+    check_fast_decimal(synthetic_numbers(args.rows))
+    print("fmt_decimal_column: OK")
+    check_fast_eur_price(args.rows)
+    print("eur_price_units: OK")
+
+
+if __name__ == "__main__":
+    run()
@@ -1,11 +1,44 @@
 #!/usr/bin/env python3
 import argparse
+import bisect
+import bz2
+import contextlib
+import cProfile
 import csv
+import functools
+import gzip
+import hashlib
+import io
+import lzma
 import os
+import sqlite3
 import datetime
+import heapq
+import itertools
+import json
+import mmap
+import pickle
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import zipfile
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
-from xml.etree.ElementTree import Element, SubElement, tostring
-from xml.dom import minidom
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.etree import ElementTree
+from xml.etree.ElementTree import Element, SubElement
+from xml.parsers import expat
+from operator import itemgetter
+from typing import Callable, Iterable, Iterator, NamedTuple, Sequence
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 # =========================
 # USER SETTINGS (EDIT THIS)
@@ -30,6 +63,16 @@ INPUT_FOLDER = "input"
 RATE_FOLDER = "rate"
 OUTPUT_FOLDER = "output"
 OUTPUT_FILENAME = "output.xml"
+DIVIDENDS_FILENAME = "output_div.xml"
+FIFO_GAINS_FILENAME = "fifo_gains.csv"
+FIFO_LOTS_FILENAME = "fifo_open_lots.csv"
+INPUT_CACHE_FILE = "input_cache.sqlite3"
+CORPORATE_ACTIONS_FILE = "corporate_actions.csv"  # optional splits / renames, used if it exists
+XSD_FOLDER = "xsd"
+XSD_MAIN_FILE = "Doh_KDVP_9.xsd"
+
+# Doh-Div: statement written for dividends with foreign (withholding) tax, to claim the treaty relief
+DIVIDEND_RELIEF_STATEMENT = "Uveljavljam odbitek tujega davka po konvenciji o izogibanju dvojnega obdavčevanja."
 
 # Supported actions (Trading 212 export)
 SUPPORTED_ACTIONS = {"Market sell", "Market buy", "Limit sell", "Limit buy", "Stop sell"}
@@ -37,6 +80,9 @@ SUPPORTED_ACTIONS = {"Market sell", "Market buy", "Limit sell", "Limit buy", "St
 # We only include tickers that have at least one sell (KDVP is about disposals)
 SELL_ACTIONS = {"Market sell", "Limit sell", "Stop sell"}
 
+# Dividend rows (--dividends): "Dividend (Ordinary)", "Dividend (Dividend)", ...
+DIVIDEND_ACTION = "Dividend"
+
 # eDavki supports up to 8 decimals for these fields (XSD patterns)
 DECIMAL_RULES = {
     # Positive decimal, max 14 digits before '.', max 8 after
@@ -50,10 +96,189 @@ DECIMAL_RULES = {
 # One step at 8 decimals
 Q8 = Decimal("0.00000001")
 
+# Split-restated quantities and prices (finite for uneven ratios, exact for usual ones)
+SPLIT_Q = Decimal("1e-12")
+
+# Fixed-point fast path: numbers as integers in units of 10^-8
+UNITS = 10 ** 8
+PLAIN_DECIMAL = re.compile(r"([-+]?)(\d*)(?:\.(\d*))?")
+
+# Decimal default context precision (products with more digits are rounded by Decimal)
+DECIMAL_PRECISION = 28
+
+# Transactions converted per batch (columns are formatted a batch at a time)
+BATCH_SIZE = 4096
+
+# Trading 212 quotes some listings in a currency subunit (LSE: pence)
+CURRENCY_SUBUNITS = {"GBX": ("GBP", Decimal("100"))}
+
+# Compressed input files are decompressed while reading (by extension, e.g. export_2023.csv.gz)
+COMPRESSED_OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+# CSV member of a zip archive in the input folder: "exports.zip/export_2023.csv"
+ZIP_MEMBER = re.compile(r"(.+?\.zip)[/\\](.+)", re.IGNORECASE)
+
+# Holding period tiers of the Slovenian capital gains tax (full years held)
+HOLDING_TIERS = ((20, "20+"), (15, "15-20"), (10, "10-15"), (5, "5-10"), (0, "<5"))
+
+# Gains report amounts are rounded to cents
+CENTS = Decimal("0.01")
+
+# Bump when the binary rate cache layout changes
+RATE_CACHE_VERSION = 2
+
+# Bump when the compiled XSD layout (xsd/cache) changes
+XSD_CACHE_VERSION = 2
+
+# Bump when the input cache schema (or what is stored in it) changes
+INPUT_CACHE_VERSION = 5
+
+# Bump when the columnar trades file layout changes
+TRADES_VERSION = 2
+
+
+class Transaction(NamedTuple):
+    """One supported Trading 212 row, parsed once while streaming the CSV."""
+    time: str
+    ticker: str
+    action: str  # full action, e.g. "Market sell"
+    side: str  # "buy" / "sell"
+    quantity: Decimal
+    price: Decimal
+    currency: str
+    rate: Decimal | None  # None when the export has no usable exchange rate
+    base_currency: str  # base currency of the export the row comes from
+    source: str  # CSV file name
+    line: int  # line number inside the CSV file
+    eur_price: int | None = None  # EUR unit price in units of 10^-8, if already converted (input cache)
+
+
+class Dividend(NamedTuple):
+    """One Trading 212 dividend row (Doh-Div), parsed while scanning the CSV."""
+    time: str
+    isin: str
+    ticker: str
+    name: str
+    action: str  # e.g. "Dividend (Ordinary)"
+    quantity: Decimal  # shares
+    price: Decimal  # gross dividend per share
+    currency: str
+    rate: Decimal | None
+    withholding_tax: Decimal  # in withholding_currency, 0 if the export has none
+    withholding_currency: str
+    base_currency: str
+    source: str
+    line: int
+
+
+class CorporateAction(NamedTuple):
+    """One row of the corporate action table (trades before date are restated)."""
+    date: str  # effective date, YYYY-MM-DD
+    ticker: str
+    action: str  # "split" / "rename"
+    ratio: Decimal  # split: new shares per old share (1 for renames)
+    new_ticker: str  # rename: ticker from date on
+
+
+class RateTable(NamedTuple):
+    """
+    Daily rates of one currency, indexed by date ordinal (day 0 = first_ordinal).
+    Days without a rate (weekends, holidays) hold the last known rate.
+    Values are integers scaled by 10^scale (a plain array or an mmap of the cache).
+    """
+    currency: str
+    first_ordinal: int
+    scale: int
+    per_eur: bool  # True: units of currency per 1 EUR (ECB), False: EUR per 1 unit
+    values: Sequence[int]
+    decoded: dict[int, Decimal]  # index -> Decimal, filled on first lookup
+    quoted: bytes | None = None  # bitmap of days with a published rate (built tables; cache: <CUR>.days)
+
+
+class Taxpayer(NamedTuple):
+    """Taxpayer data written into the EDP header and KDVP metadata."""
+    tax_number: str
+    full_name: str
+    address: str
+    city: str
+    post_number: str
+    birth_date: str
+    email: str
+    phone: str
+
+
+class Options(NamedTuple):
+    """Conversion options (the same as the CLI flags)."""
+    fix_rounding_error: bool = False
+    group_by_ticker: bool = False
+    jobs: int = 1
+    cache_file: str | None = None  # input cache (--cache), None = disabled
+    filter_year: bool = False  # keep only rows relevant to the report year (--year)
+    fifo: bool = False  # match sales to purchases (FIFO) and report realized gains (--fifo)
+    dividends: bool = False  # also build the Doh-Div XML from dividend rows (--dividends)
+    corporate_actions_file: str | None = None  # splits / renames applied to trades (--corporate-actions)
+    rate_folder: str = RATE_FOLDER
+    verbose: bool = False  # progress messages on stdout
+
+
+class RoundingAdjustment(NamedTuple):
+    """One quantity changed by --fix-rounding-error."""
+    ticker: str
+    action: str
+    date: str
+    source: str
+    line: int
+    diff: Decimal  # applied to the net holding
+    quantity: Decimal  # adjusted quantity (8 decimals)
+
+
+class RealizedGain(NamedTuple):
+    """One sale (or the part of it) matched to one purchase lot by --fifo."""
+    ticker: str
+    sell_date: str
+    buy_date: str  # "" if the sale has no matching purchase
+    quantity: Decimal
+    buy_price: Decimal | None  # EUR unit prices
+    sell_price: Decimal
+    gain: Decimal | None  # EUR, full precision
+    holding_days: int | None
+    holding_tier: str  # HOLDING_TIERS label, "unmatched" without a purchase
+    source: str  # sale CSV file and line
+    line: int
+
+
+class OpenLot(NamedTuple):
+    """Purchase lot (or its rest) still held after all sales."""
+    ticker: str
+    buy_date: str
+    quantity: Decimal
+    buy_price: Decimal  # EUR unit price
+    source: str
+    line: int
+
+
+class CsvLayout(NamedTuple):
+    """Column layout of one CSV file (Trading 212 headers differ between exports)."""
+    indices: dict[str, int]
+    base_currency: str
+    # Returns (action, ticker, time, quantity, price, currency, rate) from a row
+    fields: Callable[[list[str]], tuple]
+    # Returns (time, ticker, action, quantity, price): dedup key for rows without an ID
+    key_fields: Callable[[list[str]], tuple]
+    # "Currency (Total)" / "Currency (Result)" column of current exports (plain "Total"
+    # header): the base currency is read from the rows, None if it is in the header
+    base_column: int | None = None
+
 
 # =========================
 # HELPERS
 # =========================
+def log(state: dict, *args) -> None:
+    """Print a progress message (only for verbose runs, the CLI is verbose)."""
+    if state["verbose"]:
+        print(*args)
+
+
 def get_files(folder: str) -> list[str]:
     """Return a list of files in a folder."""
     if not os.path.exists(folder):
@@ -61,20 +286,88 @@ def get_files(folder: str) -> list[str]:
     return [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f))]
 
 
-def save_file(data: str, output_folder: str = OUTPUT_FOLDER, filename: str = OUTPUT_FILENAME) -> str:
-    """Save XML string into output folder."""
+def save_file(data: str | Iterable[str], output_folder: str = OUTPUT_FOLDER, filename: str = OUTPUT_FILENAME) -> str:
+    """Save XML string (or XML chunks, written as they come) into output folder."""
     os.makedirs(output_folder, exist_ok=True)
     path = os.path.join(output_folder, filename)
     with open(path, "w", encoding="utf-8") as f:
-        f.write(data)
+        if isinstance(data, str):
+            f.write(data)
+        else:
+            f.writelines(data)
     return path
 
 
-def prettify(elem) -> str:
-    """Return a pretty formatted XML string."""
-    rough_string = tostring(elem, "utf-8")
-    parsed = minidom.parseString(rough_string)
-    return parsed.toprettyxml(indent="  ")
+def escape_xml(text: str) -> str:
+    """Escape text and attribute values (same rules as minidom)."""
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if '"' in text:
+        text = text.replace('"', "&quot;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+
+def Fragment(text: str):
+    """Element holding already serialized XML lines (prettify writes them as they are)."""
+    elem = Element(Fragment)
+    elem.text = text
+    return elem
+
+
+def pretty_lines(elem, depth: int = 0, indent: str = "  ") -> Iterator[str]:
+    """Yield elem and its children as pretty formatted lines, starting at depth."""
+    # Work items: (element, depth) to open an element, (text, depth) for text
+    # between child elements and (None, tag, depth) to close an element
+    stack: list[tuple] = [(elem, depth)]
+    while stack:
+        item = stack.pop()
+        if len(item) == 3:
+            yield f"{indent * item[2]}</{item[1]}>\n"
+            continue
+
+        node, depth = item
+        pad = indent * depth
+        if isinstance(node, str):
+            yield f"{pad}{escape_xml(node)}\n"
+            continue
+
+        tag = node.tag
+        if tag is Fragment:
+            yield node.text
+            continue
+
+        attrs = "".join(f' {name}="{escape_xml(value)}"' for name, value in node.items())
+        text = node.text
+
+        if not len(node):
+            if text:
+                yield f"{pad}<{tag}{attrs}>{escape_xml(text)}</{tag}>\n"
+            else:
+                yield f"{pad}<{tag}{attrs}/>\n"
+            continue
+
+        yield f"{pad}<{tag}{attrs}>\n"
+        stack.append((None, tag, depth))
+        for child in reversed(node):
+            if child.tail:
+                stack.append((child.tail, depth + 1))
+            stack.append((child, depth + 1))
+        if text:
+            stack.append((text, depth + 1))
+
+
+def prettify(elem, indent: str = "  ") -> Iterator[str]:
+    """
+    Yield a pretty formatted XML document, one line at a time.
+    Output is the same as minidom toprettyxml(indent="  "), but the tree is
+    written directly, without serializing and parsing it into a second DOM.
+    """
+    yield '<?xml version="1.0" ?>\n'
+    yield from pretty_lines(elem, 0, indent)
 
 
 def to_decimal(value) -> Decimal:
@@ -135,44 +428,320 @@ def parse_date(time_value: str) -> str:
     return time_value.split()[0]
 
 
+# =========================
+# FIXED-POINT FAST PATH
+# =========================
+def parse_fixed(text: str) -> tuple[int, int] | None:
+    """
+    Parse a plain decimal string ("-12.3400") into (integer, decimals): (-123400, 4).
+    Returns None for anything else (exponent, NaN ...), callers then fall back to Decimal.
+    """
+    match = PLAIN_DECIMAL.fullmatch(text)
+    if match is None:
+        return None
+    sign, whole, frac = match.groups("")
+    if not (whole or frac):
+        return None
+    number = int(whole + frac)
+    return (-number if sign == "-" else number), len(frac)
+
+
+def round_units(number: int, decimals: int) -> int:
+    """Round integer number * 10^-decimals to units of 10^-8 (HALF_UP, like quantize_8)."""
+    if decimals <= 8:
+        return number * 10 ** (8 - decimals)
+    step = 10 ** (decimals - 8)
+    units, remainder = divmod(abs(number), step)
+    if 2 * remainder >= step:
+        units += 1
+    return -units if number < 0 else units
+
+
+def units_column(values: Sequence, xsd_type: str) -> list[int]:
+    """
+    Batch version of the parsing/rounding part of fmt_decimal.
+    Returns values rounded to 8 decimals (HALF_UP) as integers in units of 10^-8.
+    """
+    if xsd_type not in DECIMAL_RULES:
+        raise ValueError(f"Unknown XSD decimal type: {xsd_type}")
+    allow_negative = DECIMAL_RULES[xsd_type]["allow_negative"]
+    match_plain = PLAIN_DECIMAL.fullmatch
+
+    units = []
+    for value in values:
+        match = match_plain(str(value).strip())
+        if match is None or not (match[2] or match[3]):
+            # Not a plain decimal (e.g. exponent): Decimal fallback
+            d = to_decimal(value)
+            negative = d < 0
+            unit = int(quantize_8(d).scaleb(8))
+        else:
+            sign, whole, frac = match.groups("")
+            negative = sign == "-" and (whole + frac).strip("0") != ""
+            if len(frac) <= 8:
+                unit = int(whole + frac.ljust(8, "0"))
+            else:
+                unit = int(whole + frac[:8])
+                if frac[8] >= "5":
+                    unit += 1
+            if sign == "-":
+                unit = -unit
+        if negative and not allow_negative:
+            raise ValueError(f"Negative value not allowed for {xsd_type}: {value}")
+        units.append(unit)
+    return units
+
+
+def fmt_units_column(units: Sequence[int], xsd_type: str) -> list[str]:
+    """
+    Batch version of the formatting part of fmt_decimal (same output):
+    fixed-point, max 8 decimals without trailing zeros, max int digits, no negative zero.
+    """
+    if xsd_type not in DECIMAL_RULES:
+        raise ValueError(f"Unknown XSD decimal type: {xsd_type}")
+    int_digits = DECIMAL_RULES[xsd_type]["int_digits"]
+
+    out = []
+    for unit in units:
+        whole, frac = divmod(-unit if unit < 0 else unit, UNITS)
+        s = str(whole)
+        too_long = len(s) > int_digits
+        if frac:
+            s = f"{s}.{frac:08d}".rstrip("0")
+        if unit < 0:
+            s = "-" + s
+        if too_long:
+            raise ValueError(f"Too many digits before decimal for {xsd_type}: {s}")
+        out.append(s)
+    return out
+
+
+def fmt_decimal_column(values: Sequence, xsd_type: str) -> list[str]:
+    """Format a whole column like fmt_decimal, using integer arithmetic."""
+    return fmt_units_column(units_column(values, xsd_type), xsd_type)
+
+
 # =========================
 # FX RATES
 # =========================
-def read_rate_file(filename: str, rate_folder: str, usd_eur: dict) -> None:
-    """Read one USD/EUR CSV rate file into dict: {YYYY-MM-DD: rate}."""
+def read_rate_file(filename: str, rate_folder: str, rates: dict, pair_rates: dict) -> None:
+    """
+    Read one rate CSV file into dict: {currency: {"per_eur": bool, "days": {YYYY-MM-DD: rate}}}.
+
+    Supported formats:
+    - ECB eurofxref-hist.csv: "Date,USD,JPY,..." (units of currency per 1 EUR) -> rates
+    - single pair file named after the pair, e.g. USDEUR_1999-2025.csv: "Date,Price" -> pair_rates
+    """
     path = os.path.join(rate_folder, filename)
     with open(path, "r", newline="", encoding="utf-8") as csv_file:
         reader = csv.reader(csv_file)
-        next(reader, None)  # skip header
+        header = [column.strip() for column in next(reader, [])]
+
+        if len(header) == 2 and header[1] == "Price":
+            pair = filename[:6].upper()
+            if "EUR" not in (pair[:3], pair[3:]) or not pair.isalpha():
+                raise ValueError(f"Rate file {filename} must start with a currency pair, e.g. USDEUR.")
+            per_eur = pair[:3] == "EUR"
+            columns = {1: (pair[3:] if per_eur else pair[:3], per_eur)}
+            rates = pair_rates
+        else:
+            columns = {i: (name, True) for i, name in enumerate(header) if i > 0 and name}
+
+        for currency, per_eur in columns.values():
+            rates.setdefault(currency, {"per_eur": per_eur, "days": {}})
+
         for row in reader:
-            if row and len(row) >= 2:
-                usd_eur[row[0]] = row[1]
+            if not row:
+                continue
+            for i, (currency, _) in columns.items():
+                if i < len(row) and row[i].strip() not in ("", "N/A"):
+                    rates[currency]["days"][row[0].strip()] = row[i].strip()
+
+
+def build_rate_table(currency: str, days: dict, per_eur: bool) -> RateTable:
+    """
+    Build a dense RateTable from {YYYY-MM-DD: rate}.
+    Missing days are pre-filled with the last known rate (same result as
+    searching backwards day by day).
+    """
+    by_ordinal = {datetime.date.fromisoformat(date).toordinal(): to_decimal(rate) for date, rate in days.items()}
+    scale = max(-d.as_tuple().exponent for d in by_ordinal.values())
+    scale = max(scale, 0)
+    first = min(by_ordinal)
+    last = max(by_ordinal)
+
+    values = array("q")
+    quoted = bytearray((last - first + 8) // 8)
+    current = by_ordinal[first]
+    for ordinal in range(first, last + 1):
+        current = by_ordinal.get(ordinal, current)
+        values.append(int(current.scaleb(scale)))
+    for ordinal in by_ordinal:
+        quoted[(ordinal - first) >> 3] |= 1 << ((ordinal - first) & 7)
+    return RateTable(currency, first, scale, per_eur, values, {}, bytes(quoted))
+
+
+def rate_files_fingerprint(rate_folder: str, rate_files: list[str]) -> list:
+    """Name, size and mtime of all rate files (cache is rebuilt when any of them change)."""
+    fingerprint = []
+    for filename in rate_files:
+        st = os.stat(os.path.join(rate_folder, filename))
+        fingerprint.append([filename, st.st_size, st.st_mtime_ns])
+    return fingerprint
+
+
+def write_rate_cache(cache_folder: str, fingerprint: list, tables: dict) -> None:
+    """
+    Write one binary file per currency (int64 array) and its bitmap of quoted
+    days (<CUR>.days, read by --profile) plus index.json.
+    Every file is written under a temporary name and then replaced, so processes
+    that rebuild the cache at the same time never map a half-written table.
+    """
+    os.makedirs(cache_folder, exist_ok=True)
+    suffix = f".{os.getpid()}.tmp"
+    currencies = {}
+    for currency, table in tables.items():
+        path = os.path.join(cache_folder, f"{currency}.bin")
+        with open(path + suffix, "wb") as f:
+            array("q", table.values).tofile(f)
+        os.replace(path + suffix, path)
+        days_path = os.path.join(cache_folder, f"{currency}.days")
+        with open(days_path + suffix, "wb") as f:
+            f.write(table.quoted)
+        os.replace(days_path + suffix, days_path)
+        currencies[currency] = {
+            "first_ordinal": table.first_ordinal,
+            "count": len(table.values),
+            "scale": table.scale,
+            "per_eur": table.per_eur,
+        }
+    index = {"version": RATE_CACHE_VERSION, "fingerprint": fingerprint, "currencies": currencies}
+    path = os.path.join(cache_folder, "index.json")
+    with open(path + suffix, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(path + suffix, path)
+
+
+def read_rate_cache_index(cache_folder: str, fingerprint: list) -> dict | None:
+    """Return cached currency metadata, or None if the cache is missing or stale."""
+    try:
+        with open(os.path.join(cache_folder, "index.json"), "r", encoding="utf-8") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get("version") != RATE_CACHE_VERSION or index.get("fingerprint") != fingerprint:
+        return None
+    return index["currencies"]
 
 
-def load_usd_eur_rates(rate_folder: str, state: dict) -> None:
-    """Load all USD/EUR CSV files from /rate folder."""
-    usd_eur = state["usd_eur"]
-    rate_files = [f for f in get_files(rate_folder) if f.lower().endswith(".csv")]
+def load_rates(rate_folder: str, state: dict, cache_folder: str | None = None, verbose: bool = True) -> None:
+    """
+    Load ECB rates for all currencies from /rate folder.
+    The first run parses the CSV files and writes a binary cache (into
+    rate_folder/cache unless cache_folder is given); later runs only read the
+    cache index and map a currency's table when it is first used.
+    """
+    if cache_folder is None:
+        cache_folder = os.path.join(rate_folder, "cache")
+    rate_files = sorted(f for f in get_files(rate_folder) if f.lower().endswith(".csv"))
     if not rate_files:
         raise FileNotFoundError(f"No exchange rate CSV files found in {rate_folder} folder.")
-    for filename in sorted(rate_files):
-        read_rate_file(filename, rate_folder, usd_eur)
+
+    fingerprint = rate_files_fingerprint(rate_folder, rate_files)
+    index = read_rate_cache_index(cache_folder, fingerprint)
+    if index is not None:
+        state["rates"] = {
+            "rate_folder": rate_folder,
+            "cache_folder": cache_folder,
+            "fingerprint": fingerprint,
+            "index": index,
+            "tables": {},
+        }
+        if verbose:
+            print(f"Exchange rates: {len(index)} currencies (cached)")
+        return
+
+    # Single pair files (e.g. USDEUR) take precedence over the ECB history file
+    rates: dict[str, dict] = {}
+    pair_rates: dict[str, dict] = {}
+    for filename in rate_files:
+        read_rate_file(filename, rate_folder, rates, pair_rates)
+    rates.update(pair_rates)
+
+    tables = {
+        currency: build_rate_table(currency, data["days"], data["per_eur"])
+        for currency, data in rates.items()
+        if data["days"]
+    }
+    if not tables:
+        raise ValueError(f"No exchange rates found in {rate_folder} folder.")
+
+    try:
+        write_rate_cache(cache_folder, fingerprint, tables)
+    except OSError as e:
+        if verbose:
+            print(f"Exchange rate cache not written: {e}")
+
+    state["rates"] = {
+        "rate_folder": rate_folder,
+        "cache_folder": cache_folder,
+        "fingerprint": fingerprint,
+        "index": {},
+        "tables": tables,
+    }
+    if verbose:
+        print(f"Exchange rates: {len(tables)} currencies")
+
+
+def get_rate_table(rates: dict, currency: str) -> RateTable | None:
+    """Return RateTable for a currency (mapped from the cache on first use), None if not quoted."""
+    table = rates["tables"].get(currency)
+    if table is not None:
+        return table
+
+    meta = rates["index"].get(currency)
+    if meta is None:
+        return None
+
+    with open(os.path.join(rates["cache_folder"], f"{currency}.bin"), "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    values = memoryview(mapped).cast("q")
+    if len(values) != meta["count"]:
+        raise ValueError(f"Exchange rate cache for {currency} is corrupt, delete {rates['cache_folder']}.")
+
+    table = RateTable(currency, meta["first_ordinal"], meta["scale"], meta["per_eur"], values, {})
+    rates["tables"][currency] = table
+    return table
+
+
+def rate_index(date: str, table: RateTable) -> int:
+    """Position of a date in a RateTable (raises if the table does not cover it)."""
+    index = datetime.date.fromisoformat(date).toordinal() - table.first_ordinal
+    if index < 0 or index >= len(table.values):
+        first = datetime.date.fromordinal(table.first_ordinal)
+        last = datetime.date.fromordinal(table.first_ordinal + len(table.values) - 1)
+        raise ValueError(
+            f"No {table.currency} rate for {date} (rates cover {first} to {last}, update the /rate folder)."
+        )
+    return index
 
 
-def find_usd_eur_rate(date: str, usd_eur: dict) -> Decimal:
+def find_rate(date: str, table: RateTable) -> Decimal:
     """
-    Find USD/EUR rate for a date.
-    If missing, search backwards day by day until found.
+    Find the rate for a date (constant time).
+    Missing days already hold the last known rate, so no backward search is needed.
     """
-    dt = date
-    while dt not in usd_eur:
-        dt_dt = datetime.datetime.strptime(dt, "%Y-%m-%d") - datetime.timedelta(days=1)
-        dt = dt_dt.strftime("%Y-%m-%d")
-    return to_decimal(usd_eur[dt])
+    index = rate_index(date, table)
+    rate = table.decoded.get(index)
+    if rate is None:
+        rate = table.decoded[index] = Decimal(table.values[index]).scaleb(-table.scale)
+    return rate
 
 
 def convert_to_base(price, rate) -> Decimal:
     """Convert a value using exchange rate (Trading 212 export helper)."""
+    if rate is None:
+        raise ValueError("Missing exchange rate")
     p = to_decimal(price)
     r = to_decimal(rate)
     if r == 0:
@@ -180,19 +749,199 @@ def convert_to_base(price, rate) -> Decimal:
     return p / r
 
 
-def convert_usd_to_eur(price_usd: Decimal, date: str, usd_eur: dict) -> Decimal:
-    """Convert USD price into EUR using USD/EUR rate for that date."""
-    rate = find_usd_eur_rate(date, usd_eur)
-    return price_usd * rate
+def convert_to_eur(price: Decimal, currency: str, date: str, rates: dict) -> Decimal | None:
+    """
+    Convert price into EUR with the official (ECB) rate for that date.
+    Returns None if there is no official rate for the currency.
+    """
+    divisor = None
+    if currency in CURRENCY_SUBUNITS:
+        currency, divisor = CURRENCY_SUBUNITS[currency]
+
+    table = get_rate_table(rates, currency)
+    if table is None:
+        return None
+
+    rate = find_rate(date, table)
+    eur = price / rate if table.per_eur else price * rate
+    return eur / divisor if divisor is not None else eur
+
+
+# =========================
+# CORPORATE ACTIONS (splits, renames)
+# =========================
+def parse_ratio(value: str) -> Decimal:
+    """Split ratio as new shares per old share: "10", "10:1" (10 for 1) or "1:10" (reverse split)."""
+    new, _, old = value.strip().partition(":")
+    ratio = to_decimal(new) / to_decimal(old) if old else to_decimal(new)
+    if ratio <= 0:
+        raise ValueError(f"Invalid split ratio: {value}")
+    return ratio
+
+
+def read_corporate_actions(path: str) -> list[CorporateAction]:
+    """
+    Read the corporate action table (CSV: Date,Ticker,Action,Ratio,New ticker).
+    Action is "split" (Ratio = new shares per old share) or "rename" (New ticker).
+    """
+    actions = []
+    with open(path, "r", newline="", encoding="utf-8") as csv_file:
+        reader = csv.DictReader(csv_file)
+        for row in reader:
+            if not row.get("Date"):
+                continue
+            kind = row["Action"].strip().lower()
+            if kind == "split":
+                actions.append(CorporateAction(row["Date"].strip(), row["Ticker"].strip(), kind, parse_ratio(row["Ratio"]), ""))
+            elif kind == "rename" and row.get("New ticker", "").strip():
+                actions.append(CorporateAction(row["Date"].strip(), row["Ticker"].strip(), kind, Decimal(1), row["New ticker"].strip()))
+            else:
+                raise ValueError(f"Invalid corporate action in {path} line {reader.line_num}: {row}")
+    return actions
+
+
+def build_corporate_action_index(actions: Iterable[CorporateAction]) -> dict[str, tuple[list[str], list]]:
+    """
+    Per ticker: (sorted effective dates, resolved) where resolved[i] = (ratio, ticker) is
+    what a trade before dates[i] becomes: split ratios of actions i.. multiplied (suffix
+    products) and renames followed to the final ticker (and that ticker's later splits).
+    """
+    by_ticker: dict[str, list[CorporateAction]] = {}
+    for action in sorted(actions, key=lambda action: action.date):
+        by_ticker.setdefault(action.ticker, []).append(action)
+    dates = {ticker: [action.date for action in ticker_actions] for ticker, ticker_actions in by_ticker.items()}
+    resolved: dict[tuple[str, int], list] = {}
+
+    def resolve(ticker: str, start: int, chain: tuple) -> list:
+        """Suffix results of one ticker from position start (renames resolved recursively)."""
+        if (ticker, start) in resolved:
+            return resolved[ticker, start]
+        if ticker in chain:
+            raise ValueError(f"Corporate actions rename {ticker} in a loop.")
+        ticker_actions = by_ticker.get(ticker, [])
+        suffix = [None] * (len(ticker_actions) - start) + [(Decimal(1), ticker)]
+        for i in range(len(ticker_actions) - 1, start - 1, -1):
+            action = ticker_actions[i]
+            if action.action == "split":
+                ratio, final = suffix[i - start + 1]
+                suffix[i - start] = (ratio * action.ratio, final)
+            else:
+                # Trades before the rename continue with the new ticker's actions from the rename on
+                new_start = bisect.bisect_left(dates.get(action.new_ticker, []), action.date)
+                suffix[i - start] = resolve(action.new_ticker, new_start, chain + (ticker,))[0]
+        resolved[ticker, start] = suffix
+        return suffix
+
+    return {ticker: (dates[ticker], resolve(ticker, 0, ())[:-1]) for ticker in by_ticker}
+
+
+def load_corporate_actions(path: str, state: dict) -> None:
+    """Load the corporate action table into state["corporate_actions"] (index + content hash for the input cache)."""
+    actions = read_corporate_actions(path)
+    state["corporate_actions"] = {
+        "index": build_corporate_action_index(actions),
+        "fingerprint": file_sha256(path),
+        "count": len(actions),
+    }
+
+
+def restate_split(quantity: Decimal, price: Decimal, ratio: Decimal) -> tuple[Decimal, Decimal]:
+    """
+    Quantity and price in post-split shares (the traded amount stays the same).
+    Rounded to SPLIT_Q, so uneven ratios (3:1 prices) stay finite.
+    """
+    quantity = (quantity * ratio).quantize(SPLIT_Q, rounding=ROUND_HALF_UP)
+    price = (price / ratio).quantize(SPLIT_Q, rounding=ROUND_HALF_UP)
+    return quantity, price
+
+
+def corporate_action(ticker: str, time: str, index: dict) -> tuple[str, Decimal | None]:
+    """
+    (ticker, split ratio) for a trade: actions effective after the trade's date apply
+    (binary search). The ratio is None if the trade needs no adjustment.
+    """
+    entry = index.get(ticker)
+    if entry is None:
+        return ticker, None
+    dates, resolved = entry
+    position = bisect.bisect_right(dates, time)  # "2024-06-10 15:00:00" > "2024-06-10": same-day actions already apply
+    if position == len(dates):
+        return ticker, None
+    ratio, ticker = resolved[position]
+    return ticker, (None if ratio == 1 else ratio)
 
 
 # =========================
 # CSV INPUT
 # =========================
-def validate_header(header: list[str], state: dict) -> bool:
+def is_csv_name(name: str) -> bool:
+    """True for .csv files, plain or compressed (.csv.gz, .csv.bz2, .csv.xz)."""
+    name = name.lower()
+    return name.endswith(".csv") or any(name.endswith(".csv" + ext) for ext in COMPRESSED_OPENERS)
+
+
+def list_input_files(input_folder: str) -> list[str]:
+    """CSV files in the input folder (also compressed) and CSV members of zip archives ("archive.zip/member.csv")."""
+    names = []
+    for filename in get_files(input_folder):
+        if is_csv_name(filename):
+            names.append(filename)
+        elif filename.lower().endswith(".zip"):
+            with zipfile.ZipFile(os.path.join(input_folder, filename)) as archive:
+                names.extend(
+                    f"{filename}/{info.filename}"
+                    for info in archive.infolist()
+                    if not info.is_dir() and is_csv_name(info.filename)
+                )
+    return sorted(names)
+
+
+def zip_member(path: str) -> tuple[str, str] | None:
+    """Split "input/exports.zip/export_2023.csv" into (archive path, member name); None for other files."""
+    match = ZIP_MEMBER.fullmatch(path)
+    if match is None or not os.path.isfile(match.group(1)):
+        return None
+    return match.group(1), match.group(2).replace("\\", "/")
+
+
+def input_disk_path(path: str) -> str:
+    """File on disk that holds an input file (the archive for zip members)."""
+    member = zip_member(path)
+    return path if member is None else member[0]
+
+
+@contextlib.contextmanager
+def open_input_file(input_folder: str, filename: str) -> Iterator[io.TextIOBase]:
     """
-    Find needed columns in Trading 212 CSV.
+    Open one input CSV as text. gz/bz2/xz files and zip members are decompressed
+    while reading, nothing is extracted to disk.
+    """
+    path = os.path.join(input_folder, filename)
+    member = zip_member(path)
+    opener = COMPRESSED_OPENERS.get(os.path.splitext(path)[1].lower())
+    if member is None and opener is None:
+        with open(path, "r", newline="", encoding="utf-8") as csv_file:
+            yield csv_file
+        return
+
+    with contextlib.ExitStack() as stack:
+        if member is None:
+            raw = stack.enter_context(open(path, "rb"))
+        else:
+            archive = stack.enter_context(zipfile.ZipFile(member[0]))
+            raw = stack.enter_context(archive.open(member[1]))
+        if opener is not None:
+            raw = stack.enter_context(opener(raw))
+        yield stack.enter_context(io.TextIOWrapper(raw, encoding="utf-8", newline=""))
+
+
+def validate_header(header: list[str]) -> CsvLayout | None:
+    """
+    Find needed columns in Trading 212 CSV and return the layout of this file.
     Trading 212 headers can differ between years, so we search by column prefix.
+    Current exports have no "(EUR)" suffix; their base currency is read from the
+    rows by scan_input_file (CsvLayout.base_column).
+    Returns None if the header is not a supported Trading 212 export.
     """
     required_columns = {
         "Action": None,
@@ -205,6 +954,8 @@ def validate_header(header: list[str], state: dict) -> bool:
         "Result": None,  # older export format
         "Total": None,   # newer export format
     }
+    base_currency = "EUR"
+    currency_in_header = False
 
     for index, column_name in enumerate(header):
         for required_column in required_columns:
@@ -215,243 +966,1056 @@ def validate_header(header: list[str], state: dict) -> bool:
                 if required_column in ("Result", "Total"):
                     parts = column_name.split()
                     if len(parts) > 1:
-                        state["base_currency"] = parts[1].strip("()")
+                        base_currency = parts[1].strip("()")
+                        currency_in_header = True
                     else:
-                        state["base_currency"] = "EUR"
+                        base_currency = "EUR"
 
     if all(value is None for key, value in required_columns.items() if key in ("Result", "Total")):
-        return False
+        return None
+
+    # Current exports: plain "Result" / "Total" with the base currency in its own column
+    base_column = None
+    if not currency_in_header:
+        for column in ("Currency (Total)", "Currency (Result)"):
+            if column in header:
+                base_column = header.index(column)
+                break
+
+    indices = {k: v for k, v in required_columns.items() if v is not None}
+    # Order ID (not in older exports) and columns only dividend rows use
+    for column in ("ID", "ISIN", "Name", "Withholding tax", "Currency (Withholding tax)"):
+        if column in header:
+            indices[column] = header.index(column)
+    fields = itemgetter(
+        indices["Action"],
+        indices["Ticker"],
+        indices["Time"],
+        indices["No. of shares"],
+        indices["Price / share"],
+        indices["Currency (Price / share)"],
+        indices["Exchange rate"],
+    )
+    key_fields = itemgetter(
+        indices["Time"],
+        indices["Ticker"],
+        indices["Action"],
+        indices["No. of shares"],
+        indices["Price / share"],
+    )
+    return CsvLayout(indices, base_currency, fields, key_fields, base_column)
 
-    state["header_indices"] = {k: v for k, v in required_columns.items() if v is not None}
-    return True
 
+def dedup_keys(row: list[str], layout: CsvLayout) -> tuple[str, str]:
+    """Return (ID or "", Time/Ticker/Action/No. of shares/Price / share key) of a row."""
+    i_id = layout.indices.get("ID")
+    order_id = row[i_id] if i_id is not None else ""
+    return order_id, "\x1f".join(layout.key_fields(row))
 
-def read_input_file(filename: str, input_folder: str, state: dict) -> None:
-    """Read one CSV file and store only supported actions."""
-    path = os.path.join(input_folder, filename)
-    with open(path, "r", newline="", encoding="utf-8") as csv_file:
+
+def is_duplicate(keys: tuple[str, str], state: dict) -> bool:
+    """
+    A row is a duplicate of an earlier file if its ID was seen there. Where one
+    of the two rows has no ID (older exports), the composite key is compared.
+    """
+    order_id, trade = keys
+    if order_id:
+        return order_id in state["seen_ids"] or trade in state["seen_trades_without_id"]
+    return trade in state["seen_trades"]
+
+
+def remember_keys(file_keys: list[tuple[str, str]], state: dict) -> None:
+    """Add keys of one file after it is scanned (rows inside a file are never duplicates of each other)."""
+    state["seen_ids"].update(order_id for order_id, _ in file_keys if order_id)
+    state["seen_trades"].update(trade for _, trade in file_keys)
+    state["seen_trades_without_id"].update(trade for order_id, trade in file_keys if not order_id)
+
+
+def parse_dividend(row: list[str], layout: CsvLayout, source: str, line: int) -> Dividend:
+    """Parse a dividend row (columns missing in older exports are left empty)."""
+    hi = layout.indices
+
+    def optional(column: str) -> str:
+        index = hi.get(column)
+        return row[index].strip() if index is not None and index < len(row) else ""
+
+    currency = row[hi["Currency (Price / share)"]]
+    withholding_tax = optional("Withholding tax")
+    return Dividend(
+        time=row[hi["Time"]],
+        isin=optional("ISIN"),
+        ticker=row[hi["Ticker"]],
+        name=optional("Name"),
+        action=row[hi["Action"]],
+        quantity=to_decimal(row[hi["No. of shares"]]),
+        price=to_decimal(row[hi["Price / share"]]),
+        currency=currency,
+        rate=parse_rate(row[hi["Exchange rate"]]),
+        withholding_tax=abs(to_decimal(withholding_tax)) if withholding_tax else Decimal(0),
+        withholding_currency=optional("Currency (Withholding tax)") or currency,
+        base_currency=(layout.base_column is not None and row[layout.base_column].strip()) or layout.base_currency,
+        source=source,
+        line=line,
+    )
+
+
+def parse_rate(value: str) -> Decimal | None:
+    """Parse the 'Exchange rate' column (it can be empty or 'Not available')."""
+    try:
+        return Decimal(value.strip())
+    except (InvalidOperation, ValueError):
+        return None
+
+
+def scan_input_file(
+    filename: str, input_folder: str, state: dict, keys: dict | None = None, dividends: list | None = None
+) -> None:
+    """
+    First (cheap) pass over one CSV file.
+    Resolves the file's own column layout, collects tickers with a sell and
+    checks if the file is sorted by time (Trading 212 exports are).
+    Rows already seen in an earlier file (overlapping exports) are marked as
+    duplicates and skipped. If keys is given, it is filled with line -> dedup keys.
+    With --year only sells in the report year count and rows after it are skipped.
+    Dividend rows are routed in the same pass: with --dividends the report year's
+    ones go to state["dividends"]; if dividends is given, it gets all of them with their keys.
+    """
+    with open_input_file(input_folder, filename) as csv_file:
         reader = csv.reader(csv_file)
         header_row = next(reader)
-        if not validate_header(header_row, state):
+        layout = validate_header(header_row)
+        if layout is None:
             raise ValueError(f"CSV header in {filename} is invalid.")
-
-        hi = state["header_indices"]
+        state["layouts"][filename] = layout
+        state["base_currencies"][filename] = layout.base_currency
+
+        hi = layout.indices
+        i_action, i_ticker, i_time = hi["Action"], hi["Ticker"], hi["Time"]
+        i_base = layout.base_column
+        row_base_currency = None  # base currency from the rows (current exports)
+
+        tickers = state["tickers_with_sell"]
+        sell_year, year_end = state["sell_year"], row_selection(state)[1]
+        actions = state["corporate_actions"] and state["corporate_actions"]["index"]
+        report_dividends = state["dividends"]
+        file_keys = []
+        duplicates = state["duplicates"][filename] = set()
+        previous_time = ""
+        for row in reader:
+            if not row:
+                continue
+            if row[i_action] not in SUPPORTED_ACTIONS:
+                if row[i_action].startswith(DIVIDEND_ACTION) and (report_dividends is not None or dividends is not None):
+                    dividend = parse_dividend(row, layout, filename, reader.line_num)
+                    row_keys = dedup_keys(row, layout)
+                    if dividends is not None:
+                        dividends.append((dividend, row_keys))
+                    if report_dividends is not None and route_dividend(dividend, row_keys, state, duplicates):
+                        file_keys.append(row_keys)
+                continue
+            if i_base is not None and row[i_base] != row_base_currency and row[i_base]:
+                if row_base_currency is not None:
+                    raise ValueError(
+                        f"{filename} line {reader.line_num}: base currency {row[i_base]} differs from {row_base_currency}."
+                    )
+                row_base_currency = row[i_base]
+            row_keys = dedup_keys(row, layout)
+            if keys is not None:
+                keys[reader.line_num] = row_keys
+            time = row[i_time]
+            if year_end is not None and time >= year_end:
+                continue
+            if is_duplicate(row_keys, state):
+                duplicates.add(reader.line_num)
+                continue
+            file_keys.append(row_keys)
+            if row[i_action] in SELL_ACTIONS and (sell_year is None or time.startswith(sell_year)):
+                tickers.add(corporate_action(row[i_ticker], time, actions)[0] if actions else row[i_ticker])
+            if time < previous_time:
+                state["unsorted_files"].add(filename)
+            previous_time = time
+        if row_base_currency is not None:
+            state["layouts"][filename] = layout._replace(base_currency=row_base_currency)
+            state["base_currencies"][filename] = row_base_currency
+        remember_keys(file_keys, state)
+        state["rows_scanned"] += reader.line_num - 1
+
+
+def read_input_file(filename: str, input_folder: str, state: dict, all_rows: bool = False) -> Iterator[Transaction]:
+    """
+    Stream one CSV file and yield supported actions as Transaction records.
+    Uses the layout found by scan_input_file, so every file is read with its own
+    columns and base currency. Rows of tickers without any sell, rows after the
+    report year (--year) and duplicates found by scan_input_file are skipped
+    before any number parsing (unless all_rows is True).
+    Splits and renames (state["corporate_actions"]) are applied to each row here.
+    """
+    tickers, year_end = row_selection(state)
+    actions = state["corporate_actions"] and state["corporate_actions"]["index"]
+    duplicates = state["duplicates"][filename]
+    layout = state["layouts"][filename]
+    fields = layout.fields
+    base_currency = layout.base_currency
+
+    with open_input_file(input_folder, filename) as csv_file:
+        reader = csv.reader(csv_file)
+        next(reader)  # header (already validated)
 
         for row in reader:
-            if row and row[hi["Action"]] in SUPPORTED_ACTIONS:
-                state["rows"].append(row)
+            if not row:
+                continue
+            action, ticker, time, quantity, price, currency, rate = fields(row)
+            if action not in SUPPORTED_ACTIONS:
+                continue
+            ratio = None
+            if actions:
+                ticker, ratio = corporate_action(ticker, time, actions)
+            if not all_rows and (
+                reader.line_num in duplicates
+                or (tickers is not None and ticker not in tickers)
+                or (year_end is not None and time >= year_end)
+            ):
+                continue
+            if ratio is None:
+                quantity, price = to_decimal(quantity), to_decimal(price)
+            else:
+                quantity, price = restate_split(to_decimal(quantity), to_decimal(price), ratio)
+            yield Transaction(
+                time=time,
+                ticker=ticker,
+                action=action,
+                side=action.split()[1].lower(),
+                quantity=quantity,
+                price=price,
+                currency=currency,
+                rate=parse_rate(rate),
+                base_currency=base_currency,
+                source=filename,
+                line=reader.line_num,
+            )
+
+
+def load_input_files(input_folder: str, state: dict, input_files: Sequence[str] | None = None) -> None:
+    """
+    Find all CSV files in /input folder, also compressed and inside zip archives
+    (or take the given file paths, relative to input_folder) and scan them (layout, tickers with sell, ordering, duplicates).
+    """
+    if input_files is None:
+        input_files = list_input_files(input_folder)
+        if not input_files:
+            raise FileNotFoundError(f"No CSV files found in {input_folder} folder.")
+    state["input_folder"] = input_folder
+    state["input_files"] = list(input_files)
+    cache = state["cache"]
+    for filename in state["input_files"]:
+        if cache is not None and load_cached_file(cache, filename, input_folder, state):
+            log(state, f"Cached file: {filename}")
+        elif cache is not None:
+            log(state, f"Parsing file: {filename}")
+            keys = {}
+            dividends = []
+            scan_input_file(filename, input_folder, state, keys, dividends)
+            import_input_file(cache, filename, input_folder, state, keys, dividends)
+        else:
+            log(state, f"Parsing file: {filename}")
+            scan_input_file(filename, input_folder, state)
+        if state["duplicates"][filename]:
+            log(state, f"  duplicates dropped: {len(state['duplicates'][filename])}")
 
 
-def load_input_files(input_folder: str, state: dict) -> None:
-    """Load all CSV files from /input folder."""
-    input_files = [f for f in get_files(input_folder) if f.lower().endswith(".csv")]
-    if not input_files:
-        raise FileNotFoundError(f"No CSV files found in {input_folder} folder.")
-    for filename in sorted(input_files):
-        print(f"Parsing file: {filename}")
-        read_input_file(filename, input_folder, state)
+def row_selection(state: dict) -> tuple[set | None, str | None]:
+    """
+    (tickers with a sell, end of the report year) that input rows are selected by.
+    With --export-trades both are None: every deduplicated row is read and exported,
+    and select_transactions applies the selection after the export.
+    """
+    if state["trades_export"] is not None:
+        return None, None
+    return state["tickers_with_sell"], state["year_end"]
 
 
-def find_tickers_with_sell(state: dict) -> None:
-    """Find tickers that have at least one sell action."""
-    hi = state["header_indices"]
-    tickers = set()
-    for row in state["rows"]:
-        if row[hi["Action"]] in SELL_ACTIONS:
-            tickers.add(row[hi["Ticker"]])
-    state["tickers_with_sell"] = tickers
+def select_transactions(stream: Iterator[Transaction], state: dict) -> Iterator[Transaction]:
+    """Keep transactions of tickers with a sell, before the end of the report year (--year)."""
+    tickers, year_end = state["tickers_with_sell"], state["year_end"]
+    for tx in stream:
+        if tx.ticker in tickers and (year_end is None or tx.time < year_end):
+            yield tx
 
 
-def compute_eur_unit_price(row: list[str], state: dict) -> Decimal:
+def iter_transactions(state: dict) -> Iterator[Transaction]:
+    """
+    Yield transactions of all input files (or the imported trades file) in time order.
+    Files are already sorted, so a k-way merge is enough (ties keep file order).
+    Only a file that is not sorted is sorted in memory.
+    With --export-trades all rows are exported and selected afterwards.
+    """
+    streams = [] if state["trades"] is None else [read_trades(state)]
+    for filename in state["input_files"]:
+        if filename in state["cached_files"]:
+            streams.append(read_cached_file(state["cache"], state["cached_files"][filename], filename, state))
+            continue
+        stream = read_input_file(filename, state["input_folder"], state)
+        if filename in state["unsorted_files"]:
+            stream = iter(sorted(stream, key=lambda tx: tx.time))
+        streams.append(stream)
+    merged = heapq.merge(*streams, key=lambda tx: tx.time)
+    if state["profile"] is not None:
+        merged = profile_transactions(merged, state)
+    if state["trades_export"] is not None:
+        merged = select_transactions(export_trades(merged, state), state)
+    return merged
+
+
+def compute_eur_unit_price(tx: Transaction, state: dict) -> Decimal:
     """
     Compute unit price in EUR.
     Trading 212 can export prices in EUR or another currency + exchange rate.
     """
-    hi = state["header_indices"]
+    return amount_to_eur(tx.price, tx.currency, tx.rate, tx.base_currency, parse_date(tx.time), state["rates"])
 
-    date = parse_date(row[hi["Time"]])
-    price = row[hi["Price / share"]]
-    currency = row[hi["Currency (Price / share)"]]
-    rate = row[hi["Exchange rate"]]
-
-    base_currency = state["base_currency"]
-    usd_eur = state["usd_eur"]
 
+def amount_to_eur(
+    price: Decimal, currency: str, rate: Decimal | None, base_currency: str, date: str, rates: dict
+) -> Decimal:
+    """
+    Convert an amount in currency into EUR on date: official rate if there is one,
+    otherwise the export's exchange rate (into base currency) and base -> EUR.
+    """
     if currency == "EUR":
-        return to_decimal(price)
+        return price
 
-    # Export base is EUR but asset currency is USD => exchange rate converts according to required (Banka Slovenije) conversion rate
-    if base_currency == "EUR" and currency == "USD":
-        return convert_usd_to_eur(to_decimal(price), date, usd_eur)
+    # Official (Banka Slovenije / ECB) rate on the transaction date, for every quoted currency
+    eur = convert_to_eur(price, currency, date, rates)
+    if eur is not None:
+        return eur
 
-    # Export base is EUR fallback to Trading212 conversion rate
+    # No official rate for this currency: export base is EUR => fallback to Trading212 conversion rate
     if base_currency == "EUR":
         return convert_to_base(price, rate)
 
-    # Export base is USD => first convert into USD base, then USD -> EUR by date
-    if base_currency == "USD":
-        usd = convert_to_base(price, rate)
-        return convert_usd_to_eur(usd, date, usd_eur)
+    # Export base is not EUR => first convert into base currency, then base -> EUR by date
+    base = convert_to_base(price, rate)
+    eur = convert_to_eur(base, base_currency, date, rates)
+    if eur is None:
+        raise ValueError(f"Unsupported base currency: {base_currency}")
+    return eur
+
+
+def eur_price_units(tx: Transaction, state: dict) -> int:
+    """
+    EUR unit price rounded to 8 decimals, as integer units of 10^-8
+    (same value as fmt_decimal(compute_eur_unit_price(tx, state))).
+    EUR prices and official rates quoted as EUR per unit (e.g. USDEUR) are
+    multiplied as integers; conversions that divide go through Decimal.
+    """
+    if tx.eur_price is not None:
+        return tx.eur_price
+
+    if tx.currency not in CURRENCY_SUBUNITS:
+        parsed = parse_fixed(str(tx.price))
+        if parsed is not None:
+            price, decimals = parsed
+            if tx.currency == "EUR":
+                return round_units(price, decimals)
+
+            table = get_rate_table(state["rates"], tx.currency)
+            if table is not None and not table.per_eur:
+                product = price * table.values[rate_index(parse_date(tx.time), table)]
+                # Decimal multiplies exactly up to its precision; beyond that keep Decimal's rounding
+                if abs(product) < 10 ** DECIMAL_PRECISION:
+                    return round_units(product, decimals + table.scale)
 
-    raise ValueError(f"Unsupported base currency: {base_currency}")
+    return units_column([compute_eur_unit_price(tx, state)], "typeDecimalPos14_8")[0]
 
 
 # =========================
-# ROUNDING FIX (OPTIONAL)
+# INPUT CACHE (--cache)
 # =========================
-def apply_rounding_reconciliation(state: dict) -> None:
+INPUT_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    base_currency TEXT NOT NULL,
+    tickers_with_sell TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    file_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    time TEXT NOT NULL,
+    ticker TEXT NOT NULL,
+    action TEXT NOT NULL,
+    quantity TEXT NOT NULL,
+    price TEXT NOT NULL,
+    currency TEXT NOT NULL,
+    rate TEXT,
+    line INTEGER NOT NULL,
+    order_id TEXT NOT NULL,
+    trade_key TEXT NOT NULL,
+    eur_price INTEGER,
+    PRIMARY KEY (file_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS dividends (
+    file_id INTEGER NOT NULL,
+    line INTEGER NOT NULL,
+    time TEXT NOT NULL,
+    isin TEXT NOT NULL,
+    ticker TEXT NOT NULL,
+    name TEXT NOT NULL,
+    action TEXT NOT NULL,
+    quantity TEXT NOT NULL,
+    price TEXT NOT NULL,
+    currency TEXT NOT NULL,
+    rate TEXT,
+    withholding_tax TEXT NOT NULL,
+    withholding_currency TEXT NOT NULL,
+    order_id TEXT NOT NULL,
+    trade_key TEXT NOT NULL,
+    PRIMARY KEY (file_id, line)
+) WITHOUT ROWID;
+"""
+
+# SQLite integers are 64-bit
+SQLITE_MAX_INT = 2 ** 63 - 1
+
+
+def open_input_cache(path: str, rates: dict, corporate_actions: dict | None = None) -> sqlite3.Connection:
     """
-    Optional fix for tiny leftovers due to rounding.
-
-    Broker can export quantities with 10 decimals.
-    eDavki accepts only 8 decimals.
-    When eDavki sums the rounded numbers, final holdings can show e.g. -0.00000001.
-
-    This function:
-    - works per ticker
-    - adjusts only ONE transaction per ticker (minimal step 0.00000001)
-    - prints exactly what was changed
+    Open (or create) the input cache.
+    Cached EUR prices depend on the rate files and cached quantities on the
+    corporate action table, so the cache is emptied when either of them (or the
+    cache version) changes. Files that no longer exist are dropped.
     """
-    hi = state["header_indices"]
-    tickers = state["tickers_with_sell"]
+    cache = sqlite3.connect(path)
+    cache.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    meta = dict(cache.execute("SELECT key, value FROM meta"))
+    rates_fingerprint = json.dumps(rates["fingerprint"])
+    actions_fingerprint = corporate_actions["fingerprint"] if corporate_actions else ""
+
+    with cache:
+        if (
+            meta.get("version") != str(INPUT_CACHE_VERSION)
+            or meta.get("rates") != rates_fingerprint
+            or meta.get("corporate_actions", "") != actions_fingerprint
+        ):
+            cache.execute("DROP TABLE IF EXISTS dividends")
+            cache.execute("DROP TABLE IF EXISTS transactions")
+            cache.execute("DROP TABLE IF EXISTS files")
+            cache.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(INPUT_CACHE_VERSION),))
+            cache.execute("INSERT OR REPLACE INTO meta VALUES ('rates', ?)", (rates_fingerprint,))
+            cache.execute("INSERT OR REPLACE INTO meta VALUES ('corporate_actions', ?)", (actions_fingerprint,))
+        cache.executescript(INPUT_CACHE_SCHEMA)
+
+        for file_id, file_path in cache.execute("SELECT id, path FROM files").fetchall():
+            if not os.path.isfile(input_disk_path(file_path)):
+                cache.execute("DELETE FROM dividends WHERE file_id = ?", (file_id,))
+                cache.execute("DELETE FROM transactions WHERE file_id = ?", (file_id,))
+                cache.execute("DELETE FROM files WHERE id = ?", (file_id,))
+    return cache
+
+
+def file_sha256(path: str) -> str:
+    """Content hash of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_cached_file(cache: sqlite3.Connection, filename: str, input_folder: str, state: dict) -> bool:
+    """
+    Use the cached records of a file if it did not change.
+    Path, size and mtime must match; if only mtime differs, the content hash decides.
+    For zip members the archive's size, mtime and hash are compared.
+    Duplicates of earlier files are found from the stored dedup keys.
+    """
+    path = os.path.abspath(os.path.join(input_folder, filename))
+    row = cache.execute(
+        "SELECT id, size, mtime_ns, sha256, base_currency, tickers_with_sell FROM files WHERE path = ?", (path,)
+    ).fetchone()
+    if row is None:
+        return False
 
-    # Stable order ensures the "last buy/sell" choice is always the same
-    rows_sorted = sorted(state["rows"], key=lambda r: r[hi["Time"]])
+    file_id, size, mtime_ns, sha256, base_currency, tickers_with_sell = row
+    disk_path = input_disk_path(path)
+    st = os.stat(disk_path)
+    if (size, mtime_ns) != (st.st_size, st.st_mtime_ns):
+        if size != st.st_size or file_sha256(disk_path) != sha256:
+            return False
+        with cache:
+            cache.execute("UPDATE files SET mtime_ns = ? WHERE id = ?", (st.st_mtime_ns, file_id))
+
+    state["cached_files"][filename] = file_id
+    state["base_currencies"][filename] = base_currency
+    sell_year, year_end = state["sell_year"], row_selection(state)[1]
+    state["tickers_with_sell"].update(
+        ticker for ticker, years in json.loads(tickers_with_sell).items() if sell_year is None or sell_year in years
+    )
 
-    # Group rows by ticker (only tickers we will include in XML)
-    rows_by_ticker: dict[str, list[list[str]]] = {}
-    for r in rows_sorted:
-        action_full = r[hi["Action"]]
-        if action_full not in SUPPORTED_ACTIONS:
+    file_keys = []
+    duplicates = state["duplicates"][filename] = set()
+    for line, time, order_id, trade_key in cache.execute(
+        "SELECT line, time, order_id, trade_key FROM transactions WHERE file_id = ?", (file_id,)
+    ):
+        if year_end is not None and time >= year_end:
             continue
-        ticker = r[hi["Ticker"]]
-        if ticker not in tickers:
+        if is_duplicate((order_id, trade_key), state):
+            duplicates.add(line)
+        else:
+            file_keys.append((order_id, trade_key))
+    if state["dividends"] is not None:
+        for row in cache.execute(
+            "SELECT time, isin, ticker, name, action, quantity, price, currency, rate, withholding_tax, "
+            "withholding_currency, line, order_id, trade_key FROM dividends WHERE file_id = ? ORDER BY line",
+            (file_id,),
+        ):
+            time, isin, ticker, name, action, quantity, price, currency, rate, tax, tax_currency, line = row[:12]
+            dividend = Dividend(
+                time, isin, ticker, name, action, Decimal(quantity), Decimal(price), currency,
+                None if rate is None else Decimal(rate), Decimal(tax), tax_currency, base_currency, filename, line,
+            )
+            if route_dividend(dividend, row[12:], state, duplicates):
+                file_keys.append(row[12:])
+    remember_keys(file_keys, state)
+    return True
+
+
+def cached_eur_price(tx: Transaction, state: dict) -> int | None:
+    """EUR price to store in the cache (None if it cannot be converted now, it is retried when used)."""
+    try:
+        units = eur_price_units(tx, state)
+    except (ValueError, ArithmeticError):
+        return None
+    return units if abs(units) <= SQLITE_MAX_INT else None
+
+
+def import_input_file(
+    cache: sqlite3.Connection, filename: str, input_folder: str, state: dict, keys: dict, dividends: list
+) -> None:
+    """
+    Parse all supported rows of a new or changed file (already scanned), convert
+    prices to EUR and store them in time order in the cache, together with the
+    dividend rows found by the scan (for --dividends).
+    Duplicates are stored too (with their dedup keys), as they depend on the other files.
+    """
+    path = os.path.abspath(os.path.join(input_folder, filename))
+    disk_path = input_disk_path(path)
+    st = os.stat(disk_path)
+    sha256 = file_sha256(disk_path)
+
+    transactions = sorted(
+        read_input_file(filename, input_folder, state, all_rows=True),
+        key=lambda tx: tx.time,
+    )
+    # Ticker -> years with a sell (--year selects tickers from the cache without parsing)
+    sell_years: dict[str, set] = {}
+    for tx in transactions:
+        if tx.action in SELL_ACTIONS:
+            sell_years.setdefault(tx.ticker, set()).add(tx.time[:4])
+    tickers_with_sell = {ticker: sorted(years) for ticker, years in sorted(sell_years.items())}
+
+    with cache:
+        cache.execute("DELETE FROM dividends WHERE file_id IN (SELECT id FROM files WHERE path = ?)", (path,))
+        cache.execute("DELETE FROM transactions WHERE file_id IN (SELECT id FROM files WHERE path = ?)", (path,))
+        cache.execute("DELETE FROM files WHERE path = ?", (path,))
+        file_id = cache.execute(
+            "INSERT INTO files (path, size, mtime_ns, sha256, base_currency, tickers_with_sell) VALUES (?, ?, ?, ?, ?, ?)",
+            (path, st.st_size, st.st_mtime_ns, sha256, state["base_currencies"][filename], json.dumps(tickers_with_sell)),
+        ).lastrowid
+        cache.executemany(
+            "INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    file_id, seq, tx.time, tx.ticker, tx.action, str(tx.quantity), str(tx.price), tx.currency,
+                    None if tx.rate is None else str(tx.rate), tx.line, *keys[tx.line], cached_eur_price(tx, state),
+                )
+                for seq, tx in enumerate(transactions)
+            ),
+        )
+        cache.executemany(
+            "INSERT INTO dividends VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    file_id, d.line, d.time, d.isin, d.ticker, d.name, d.action, str(d.quantity), str(d.price),
+                    d.currency, None if d.rate is None else str(d.rate), str(d.withholding_tax),
+                    d.withholding_currency, *dividend_keys,
+                )
+                for d, dividend_keys in dividends
+            ),
+        )
+    state["cached_files"][filename] = file_id
+
+
+def read_cached_file(cache: sqlite3.Connection, file_id: int, filename: str, state: dict) -> Iterator[Transaction]:
+    """Yield cached transactions of one file (time order), only tickers with a sell and no duplicates."""
+    tickers, year_end = row_selection(state)
+    duplicates = state["duplicates"][filename]
+    base_currency = state["base_currencies"][filename]
+    rows = cache.execute(
+        "SELECT time, ticker, action, quantity, price, currency, rate, line, eur_price "
+        "FROM transactions WHERE file_id = ? ORDER BY seq",
+        (file_id,),
+    )
+    for time, ticker, action, quantity, price, currency, rate, line, eur_price in rows:
+        if line in duplicates or (tickers is not None and ticker not in tickers) or (
+            year_end is not None and time >= year_end
+        ):
             continue
-        rows_by_ticker.setdefault(ticker, []).append(r)
+        yield Transaction(
+            time=time,
+            ticker=ticker,
+            action=action,
+            side=action.split()[1].lower(),
+            quantity=Decimal(quantity),
+            price=Decimal(price),
+            currency=currency,
+            rate=None if rate is None else Decimal(rate),
+            base_currency=base_currency,
+            source=filename,
+            line=line,
+            eur_price=eur_price,
+        )
+
+
+# =========================
+# COLUMNAR TRADES FILE (--export-trades / --import-trades)
+# =========================
+TRADES_MAGIC = b"T212TRD\0"
+
+# Column -> array typecode. Strings with few distinct values are stored as int32 codes into
+# a dictionary, decimals exactly as int64 coefficient + int8 exponent, times as an offsets + bytes blob.
+TRADE_COLUMNS = {
+    "time_end": "q",  # end offset of each time string in the "time" blob
+    "ticker": "i",
+    "action": "i",
+    "currency": "i",
+    "source": "i",
+    "line": "i",
+    "quantity": "q",
+    "quantity_exp": "b",
+    "price": "q",  # price in the quoted currency
+    "price_exp": "b",
+    "eur_price": "q",  # EUR unit price in units of 10^-8 (as written to XML)
+}
+DICTIONARY_COLUMNS = ("ticker", "action", "currency", "source")
+
+# Columns are aligned for memoryview.cast
+TRADES_ALIGN = 8
 
-    adjustments = 0
 
-    for ticker, rows in rows_by_ticker.items():
-        buys_idx: list[int] = []
-        sells_idx: list[int] = []
+def new_trade_columns() -> dict:
+    """Empty in-memory columns (filled by export_trades)."""
+    return {
+        "columns": {name: array(typecode) for name, typecode in TRADE_COLUMNS.items()},
+        "time": bytearray(),
+        "dictionaries": {name: {} for name in DICTIONARY_COLUMNS},
+        "sell_years": {},
+        "base_currencies": {},  # source file -> base currency of the export
+    }
+
 
-        # Totals at full broker precision
-        sum_buy_full = Decimal("0")
-        sum_sell_full = Decimal("0")
+def split_decimal(value: Decimal, what: str) -> tuple[int, int]:
+    """Decimal as (int64 coefficient, int8 exponent), exactly."""
+    exponent = value.as_tuple().exponent
+    coefficient = int(value.scaleb(-exponent))
+    if abs(coefficient) >= 2 ** 63 or not -128 <= exponent <= 127:
+        raise ValueError(f"{what} {value} cannot be stored in the trades file.")
+    return coefficient, exponent
+
+
+def export_trades(stream: Iterator[Transaction], state: dict) -> Iterator[Transaction]:
+    """
+    Pass transactions through (with the EUR price filled in, so it is converted
+    once) and append them to the columns in state["trades_export"], a batch at a time.
+    """
+    trades = state["trades_export"]
+    columns = trades["columns"]
+    dictionaries = trades["dictionaries"]
+    time_blob = trades["time"]
+    while batch := list(itertools.islice(stream, BATCH_SIZE)):
+        batch = [Transaction._make(tx[:-1] + (eur_price_units(tx, state),)) for tx in batch]  # eur_price is last
+        times = [tx.time.encode("utf-8") for tx in batch]
+        columns["time_end"].extend(itertools.accumulate(map(len, times), initial=len(time_blob)))
+        del columns["time_end"][-len(batch) - 1]  # the initial value
+        time_blob += b"".join(times)
+        for name, values in zip(DICTIONARY_COLUMNS, zip(*((tx.ticker, tx.action, tx.currency, tx.source) for tx in batch))):
+            codes = dictionaries[name]
+            columns[name].extend([codes.setdefault(value, len(codes)) for value in values])
+        columns["line"].extend([tx.line for tx in batch])
+        for name in ("quantity", "price"):
+            coefficients, exponents = zip(*(split_decimal(getattr(tx, name), name) for tx in batch))
+            columns[name].extend(coefficients)
+            columns[name + "_exp"].extend(exponents)
+        columns["eur_price"].extend([tx.eur_price for tx in batch])
+        for tx in batch:
+            if tx.action in SELL_ACTIONS:
+                trades["sell_years"].setdefault(tx.ticker, set()).add(tx.time[:4])
+        yield from batch
+    trades["base_currencies"] = {source: state["base_currencies"][source] for source in dictionaries["source"]}
+
+
+def write_trades_file(path: str, trades: dict) -> None:
+    """
+    Write the columns into one file: magic, header length, JSON header
+    (row count, dictionaries, column offsets) and the aligned column blocks.
+    """
+    blocks = [(name, values.tobytes()) for name, values in trades["columns"].items()]
+    blocks.append(("time", bytes(trades["time"])))
+    layout = {}
+    offset = 0
+    for name, data in blocks:
+        layout[name] = [offset, len(data)]
+        offset += -(-len(data) // TRADES_ALIGN) * TRADES_ALIGN
+    header = json.dumps({
+        "version": TRADES_VERSION,
+        "byteorder": sys.byteorder,
+        "rows": len(trades["columns"]["line"]),
+        "dictionaries": {name: list(codes) for name, codes in trades["dictionaries"].items()},
+        "tickers_with_sell": {ticker: sorted(years) for ticker, years in sorted(trades["sell_years"].items())},
+        "base_currencies": trades["base_currencies"],
+        "columns": layout,
+    }).encode("utf-8")
+    header += b" " * (-(len(TRADES_MAGIC) + 8 + len(header)) % TRADES_ALIGN)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(TRADES_MAGIC)
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        for _, data in blocks:
+            f.write(data)
+            f.write(b"\0" * (-len(data) % TRADES_ALIGN))
+    os.replace(tmp_path, path)
+
+
+def open_trades_file(path: str) -> dict:
+    """
+    Map a trades file: {"rows", "dictionaries", "tickers_with_sell", "base_currencies",
+    "columns": {name: memoryview}, "time": memoryview}.
+    Nothing is parsed, columns are read straight from the mapped file.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(TRADES_MAGIC)) != TRADES_MAGIC:
+            raise ValueError(f"{path} is not a trades file.")
+        header_length = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_length))
+        if header.get("version") != TRADES_VERSION:
+            raise ValueError(f"{path} was written by a different version, export it again.")
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} was written on a machine with a different byte order.")
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    data = memoryview(mapped)[len(TRADES_MAGIC) + 8 + header_length:]
+    columns = {}
+    for name, typecode in TRADE_COLUMNS.items():
+        offset, length = header["columns"][name]
+        columns[name] = data[offset:offset + length].cast(typecode)
+        if len(columns[name]) != header["rows"]:
+            raise ValueError(f"{path} is corrupt (column {name}).")
+    offset, length = header["columns"]["time"]
+    return {
+        "rows": header["rows"],
+        "dictionaries": header["dictionaries"],
+        "tickers_with_sell": header["tickers_with_sell"],
+        "base_currencies": header["base_currencies"],
+        "columns": columns,
+        "time": data[offset:offset + length],
+    }
 
-        # Totals after rounding each row to 8 decimals
-        sum_buy_8 = Decimal("0")
-        sum_sell_8 = Decimal("0")
 
-        for idx, r in enumerate(rows):
-            action = r[hi["Action"]].split()[1].lower()  # buy / sell
-            qty_full = to_decimal(r[hi["No. of shares"]])
-            qty_8 = quantize_8(qty_full)
+def load_trades_file(path: str, state: dict) -> None:
+    """Use a trades file instead of the input CSV files (--year selects tickers and rows as for CSV)."""
+    trades = open_trades_file(path)
+    sell_year = state["sell_year"]
+    state["trades"] = trades
+    state["tickers_with_sell"].update(
+        ticker for ticker, years in trades["tickers_with_sell"].items() if sell_year is None or sell_year in years
+    )
+    state["base_currencies"].update(trades["base_currencies"])
+
+
+def read_trades(state: dict) -> Iterator[Transaction]:
+    """Yield transactions of the trades file (time order) with EUR prices already converted."""
+    trades = state["trades"]
+    columns = trades["columns"]
+    tickers, actions, currencies, sources = (trades["dictionaries"][name] for name in DICTIONARY_COLUMNS)
+    base_currencies = [trades["base_currencies"][source] for source in sources]
+    sides = [action.split()[1].lower() for action in actions]
+    time_blob = trades["time"]
+    selected, year_end = row_selection(state)
+    start = 0
+    # Columns in TRADE_COLUMNS order
+    for end, ticker, action, currency, source, line, quantity, quantity_exp, price, price_exp, eur_price in zip(
+        *(columns[name] for name in TRADE_COLUMNS)
+    ):
+        time = str(time_blob[start:end], "utf-8")
+        start = end
+        if (selected is not None and tickers[ticker] not in selected) or (year_end is not None and time >= year_end):
+            continue
+        yield Transaction(
+            time,
+            tickers[ticker],
+            actions[action],
+            sides[action],
+            Decimal(quantity).scaleb(quantity_exp),
+            Decimal(price).scaleb(price_exp),
+            currencies[currency],
+            None,
+            base_currencies[source],
+            sources[source],
+            line,
+            eur_price,
+        )
 
-            if action == "buy":
-                buys_idx.append(idx)
-                sum_buy_full += qty_full
-                sum_buy_8 += qty_8
-            elif action == "sell":
-                sells_idx.append(idx)
-                sum_sell_full += qty_full
-                sum_sell_8 += qty_8
 
-        # What the net should be in an 8-decimal world (based on full precision)
-        net_target = quantize_8(sum_buy_full - sum_sell_full)
+# =========================
+# ROUNDING FIX (OPTIONAL)
+# =========================
+def track_rounding(rounding: dict, tx: Transaction, quantity: int, row, row_id: int) -> None:
+    """
+    Add one transaction to the running per-ticker totals used by --fix-rounding-error.
+    rounding[ticker] = [sum_buy_full, sum_sell_full, sum_buy_8, sum_sell_8, last_buy, last_sell];
+    8-decimal sums are in fixed-point units (the quantities written to XML),
+    last_buy / last_sell are (transaction, quantity units, Row element, row ID).
+    """
+    t = rounding.get(tx.ticker)
+    if t is None:
+        t = rounding[tx.ticker] = [Decimal("0"), Decimal("0"), 0, 0, None, None]
+
+    # Totals at full broker precision and after rounding each row to 8 decimals
+    if tx.side == "buy":
+        t[0] += tx.quantity
+        t[2] += quantity
+        t[4] = (tx, quantity, row, row_id)
+    elif tx.side == "sell":
+        t[1] += tx.quantity
+        t[3] += quantity
+        t[5] = (tx, quantity, row, row_id)
+
+
+def finish_rounding(rounding: dict, securities_by_ticker: dict) -> list[RoundingAdjustment]:
+    """
+    Optional fix for tiny leftovers due to rounding.
 
-        # What eDavki will get when summing already-rounded rows
-        net_rounded = quantize_8(sum_buy_8 - sum_sell_8)
+    Broker can export quantities with 10 decimals.
+    eDavki accepts only 8 decimals.
+    When eDavki sums the rounded numbers, final holdings can show e.g. -0.00000001.
 
-        # Rounding drift
-        diff = quantize_8(net_target - net_rounded)
+    Runs after all transactions were added to XML (totals from track_rounding):
+    - works per ticker
+    - adjusts only ONE transaction per ticker (minimal step 0.00000001), the last
+      buy or sell in time order, by updating its quantity in the built XML
+      (and the following F8 holdings in grouped output)
+    - returns what was changed
+    """
+    adjustments = []
+    for ticker, (sum_buy_full, sum_sell_full, sum_buy_8, sum_sell_8, last_buy, last_sell) in rounding.items():
+        # What the net should be in an 8-decimal world (based on full precision),
+        # minus what eDavki will get when summing already-rounded rows
+        net_target = int(quantize_8(sum_buy_full - sum_sell_full).scaleb(8))
+        diff = net_target - (sum_buy_8 - sum_sell_8)
         if diff == 0:
             continue
 
         # Apply diff to exactly one row (deterministic rule)
-        chosen = None
-        new_qty = None
-
         if diff > 0:
             # Need to increase net
-            if buys_idx:
-                chosen = buys_idx[-1]  # last buy
-                old = quantize_8(to_decimal(rows[chosen][hi["No. of shares"]]))
-                new_qty = quantize_8(old + diff)
-            elif sells_idx:
-                chosen = sells_idx[-1]  # last sell
-                old = quantize_8(to_decimal(rows[chosen][hi["No. of shares"]]))
-                new_qty = quantize_8(old - diff)
+            chosen, step = (last_buy, diff) if last_buy is not None else (last_sell, -diff)
         else:
             # Need to decrease net
-            need = -diff
-            if sells_idx:
-                chosen = sells_idx[-1]  # last sell
-                old = quantize_8(to_decimal(rows[chosen][hi["No. of shares"]]))
-                new_qty = quantize_8(old + need)
-            elif buys_idx:
-                chosen = buys_idx[-1]  # last buy
-                old = quantize_8(to_decimal(rows[chosen][hi["No. of shares"]]))
-                new_qty = quantize_8(old - need)
-
-        if chosen is None or new_qty is None:
+            chosen, step = (last_sell, -diff) if last_sell is not None else (last_buy, diff)
+        if chosen is None:
             continue
 
-        if new_qty <= 0:
+        tx, quantity, row, row_id = chosen
+        new_quantity = quantity + step
+        new_qty = quantize_8(Decimal(new_quantity).scaleb(-8))
+        if new_quantity <= 0:
             raise ValueError(f"[rounding-fix] {ticker}: adjustment would make quantity <= 0 ({new_qty})")
 
-        # Store adjusted quantity back into the row
-        rows[chosen][hi["No. of shares"]] = format(new_qty, "f")
-        adjustments += 1
+        path = "Purchase/F3" if tx.side == "buy" else "Sale/F7"
+        row.find(path).text = fmt_units_column([new_quantity], "typeDecimalPos12_8")[0]
 
-        action = rows[chosen][hi["Action"]]
-        when = parse_date(rows[chosen][hi["Time"]])
-        print(f"[rounding-fix] {ticker}: applied {format(diff, 'f')} via {action} on {when}")
+        # Grouped output: holdings (F8) from the adjusted row on move by the same diff
+        entry = securities_by_ticker.get(ticker)
+        if entry is not None:
+            for f8, holding in entry[3][row_id:]:
+                f8.text = fmt_units_column([holding + diff], "typeDecimalNeg12_8")[0]
 
-    if adjustments == 0:
+        adjustments.append(
+            RoundingAdjustment(ticker, tx.action, parse_date(tx.time), tx.source, tx.line, Decimal(diff).scaleb(-8), new_qty)
+        )
+    return adjustments
+
+
+def print_rounding_report(adjustments: list[RoundingAdjustment]) -> None:
+    """Print what --fix-rounding-error changed."""
+    for adj in adjustments:
+        print(f"[rounding-fix] {adj.ticker}: applied {format(adj.diff, 'f')} via {adj.action} on {adj.date}")
+    if not adjustments:
         print("[rounding-fix] no adjustments were needed")
     else:
-        print(f"[rounding-fix] applied adjustments: {adjustments}")
+        print(f"[rounding-fix] applied adjustments: {len(adjustments)}")
+
+
+# =========================
+# FIFO LOT MATCHING (--fifo)
+# =========================
+def holding_tier(buy: datetime.date, sell: datetime.date) -> str:
+    """Tier label by full years held (anniversary of the purchase date)."""
+    years = max(0, sell.year - buy.year - ((sell.month, sell.day) < (buy.month, buy.day)))
+    return next(label for min_years, label in HOLDING_TIERS if years >= min_years)
+
+
+def match_fifo(fifo: dict, tx: Transaction, price: int) -> None:
+    """
+    Add one transaction (time order) to the per-ticker FIFO lot queues.
+    fifo = {"lots": {ticker: deque of [buy day, quantity left, EUR price units, source, line]},
+    "realized": [RealizedGain]}. Quantities are full broker precision, so selling
+    a whole position leaves no rounding leftovers. Each lot is removed once it is
+    used up, so matching is amortized O(1) per transaction.
+    """
+    lots = fifo["lots"].get(tx.ticker)
+    if lots is None:
+        lots = fifo["lots"][tx.ticker] = deque()
+    day = datetime.date.fromisoformat(parse_date(tx.time))
+    if tx.side == "buy":
+        lots.append([day, tx.quantity, price, tx.source, tx.line])
+        return
+
+    realized = fifo["realized"]
+    date = day.isoformat()
+    sell_price = Decimal(price).scaleb(-8)
+    remaining = tx.quantity
+    while remaining > 0 and lots:
+        lot = lots[0]
+        buy_day, available, buy_price = lot[0], lot[1], lot[2]
+        used = min(available, remaining)
+        realized.append(RealizedGain(
+            tx.ticker, date, buy_day.isoformat(), used, Decimal(buy_price).scaleb(-8), sell_price,
+            used * Decimal(price - buy_price).scaleb(-8), (day - buy_day).days,
+            holding_tier(buy_day, day), tx.source, tx.line,
+        ))
+        remaining -= used
+        if used == available:
+            lots.popleft()
+        else:
+            lot[1] = available - used
+
+    if remaining > 0:
+        # Sold more than was bought (missing older exports)
+        realized.append(
+            RealizedGain(tx.ticker, date, "", remaining, None, sell_price, None, None, "unmatched", tx.source, tx.line)
+        )
+
+
+def open_lots(fifo: dict) -> list[OpenLot]:
+    """Lots still held after all sales (per ticker, oldest first)."""
+    return [
+        OpenLot(ticker, buy_day.isoformat(), quantity, Decimal(price).scaleb(-8), source, line)
+        for ticker, lots in fifo["lots"].items()
+        for buy_day, quantity, price, source, line in lots
+    ]
+
+
+def write_fifo_report(
+    realized: list[RealizedGain], lots: list[OpenLot], year: str | None = None, output_folder: str = OUTPUT_FOLDER
+) -> None:
+    """
+    Write realized gains (with the tax year of the sale) and open lots CSV files and
+    print totals per holding tier. With year, totals and unmatched sales count only
+    sales in that year (earlier sales are matched too, as they use up older lots).
+    """
+    os.makedirs(output_folder, exist_ok=True)
+
+    def amount(value: Decimal | None) -> str:
+        return "" if value is None else format(value.quantize(CENTS, rounding=ROUND_HALF_UP), "f")
+
+    totals: dict[str, Decimal] = {}
+    unmatched = 0
+    other_years = set()  # (source, line) of sales outside the report year
+    gains_path = os.path.join(output_folder, FIFO_GAINS_FILENAME)
+    with open(gains_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow([
+            "Tax year", "Ticker", "Sell date", "Buy date", "Quantity", "Buy price EUR", "Sell price EUR",
+            "Cost EUR", "Proceeds EUR", "Gain EUR", "Holding days", "Holding tier", "Source", "Line",
+        ])
+        for r in realized:
+            cost = None if r.buy_price is None else r.quantity * r.buy_price
+            writer.writerow([
+                r.sell_date[:4], r.ticker, r.sell_date, r.buy_date, format(r.quantity, "f"),
+                "" if r.buy_price is None else format(r.buy_price, "f"), format(r.sell_price, "f"),
+                amount(cost), amount(r.quantity * r.sell_price), amount(r.gain),
+                "" if r.holding_days is None else r.holding_days, r.holding_tier, r.source, r.line,
+            ])
+            if year is not None and not r.sell_date.startswith(year):
+                other_years.add((r.source, r.line))
+            elif r.gain is None:
+                unmatched += 1
+            else:
+                totals[r.holding_tier] = totals.get(r.holding_tier, Decimal("0")) + r.gain
+
+    lots_path = os.path.join(output_folder, FIFO_LOTS_FILENAME)
+    with open(lots_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Ticker", "Buy date", "Quantity", "Buy price EUR", "Cost EUR", "Source", "Line"])
+        for lot in lots:
+            writer.writerow([
+                lot.ticker, lot.buy_date, format(lot.quantity, "f"), format(lot.buy_price, "f"),
+                amount(lot.quantity * lot.buy_price), lot.source, lot.line,
+            ])
+
+    in_year = "" if year is None else f" in {year}"
+    for _, label in reversed(HOLDING_TIERS):
+        if label in totals:
+            print(f"[fifo] gain held {label} years{in_year}: {amount(totals[label])} EUR")
+    if unmatched:
+        print(f"[fifo] sales without a matching purchase{in_year}: {unmatched}")
+    if other_years:
+        print(f"[fifo] sales of other years (not in the totals, see Tax year): {len(other_years)}")
+    print("[fifo] realized gains saved to:", gains_path)
+    print("[fifo] open lots saved to:", lots_path)
 
 
 # =========================
 # XML BUILDING
 # =========================
-def header_xml(root) -> None:
+def header_xml(root, taxpayer: Taxpayer) -> None:
     """Add EDP header with taxpayer information."""
     header_elem = SubElement(root, "edp:Header")
-    taxpayer = SubElement(header_elem, "edp:taxpayer")
-    SubElement(taxpayer, "edp:taxNumber").text = TAX_NUMBER
-    SubElement(taxpayer, "edp:taxpayerType").text = "FO"
-    SubElement(taxpayer, "edp:name").text = FULL_NAME
-    SubElement(taxpayer, "edp:address1").text = ADDRESS
-    SubElement(taxpayer, "edp:city").text = CITY
-    SubElement(taxpayer, "edp:postNumber").text = POST_NUMBER
-    SubElement(taxpayer, "edp:birthDate").text = BIRTH_DATE
+    taxpayer_elem = SubElement(header_elem, "edp:taxpayer")
+    SubElement(taxpayer_elem, "edp:taxNumber").text = taxpayer.tax_number
+    SubElement(taxpayer_elem, "edp:taxpayerType").text = "FO"
+    SubElement(taxpayer_elem, "edp:name").text = taxpayer.full_name
+    SubElement(taxpayer_elem, "edp:address1").text = taxpayer.address
+    SubElement(taxpayer_elem, "edp:city").text = taxpayer.city
+    SubElement(taxpayer_elem, "edp:postNumber").text = taxpayer.post_number
+    SubElement(taxpayer_elem, "edp:birthDate").text = taxpayer.birth_date
 
 
-def KDVP_metadata(root) -> None:
+def KDVP_metadata(root, taxpayer: Taxpayer, year: str, period: tuple[str, str], security_count: int = 0) -> None:
     """Add KDVP metadata required by eDavki."""
     kdvp_elem = SubElement(root, "KDVP")
     SubElement(kdvp_elem, "DocumentWorkflowID").text = "O"
-    SubElement(kdvp_elem, "Year").text = TAX_YEAR
-    SubElement(kdvp_elem, "PeriodStart").text = PERIOD_START
-    SubElement(kdvp_elem, "PeriodEnd").text = PERIOD_END
+    SubElement(kdvp_elem, "Year").text = year
+    SubElement(kdvp_elem, "PeriodStart").text = period[0]
+    SubElement(kdvp_elem, "PeriodEnd").text = period[1]
     SubElement(kdvp_elem, "IsResident").text = "true"
-    SubElement(kdvp_elem, "TelephoneNumber").text = PHONE
-    SubElement(kdvp_elem, "SecurityCount").text = "0"
+    SubElement(kdvp_elem, "TelephoneNumber").text = taxpayer.phone
+    SubElement(kdvp_elem, "SecurityCount").text = str(security_count)
     SubElement(kdvp_elem, "SecurityShortCount").text = "0"
     SubElement(kdvp_elem, "SecurityWithContractCount").text = "0"
     SubElement(kdvp_elem, "SecurityWithContractShortCount").text = "0"
     SubElement(kdvp_elem, "ShareCount").text = "0"
-    SubElement(kdvp_elem, "Email").text = EMAIL
+    SubElement(kdvp_elem, "Email").text = taxpayer.email
 
 
-def KVDP_item(root, ticker: str):
-    """
-    Create one KDVPItem + Securities + one Row (ID=0).
-    This matches the original structure of the script.
-    """
+def KDVP_securities(root, ticker: str):
+    """Create one KDVPItem + Securities for a ticker (rows are added with security_row)."""
     item_elem = SubElement(root, "KDVPItem")
     SubElement(item_elem, "InventoryListType").text = "PLVP"
     SubElement(item_elem, "Name").text = ticker
@@ -463,34 +2027,109 @@ def KVDP_item(root, ticker: str):
     securities = SubElement(item_elem, "Securities")
     SubElement(securities, "Code").text = ticker
     SubElement(securities, "IsFond").text = "false"
+    return securities
+
 
+def security_row(securities, row_id: int):
+    """Add one Row with its running number into Securities."""
     row_elem = SubElement(securities, "Row")
-    SubElement(row_elem, "ID").text = "0"
+    SubElement(row_elem, "ID").text = str(row_id)
     return row_elem
 
 
+def KVDP_item(root, ticker: str):
+    """
+    Create one KDVPItem + Securities + one Row (ID=0).
+    This matches the original structure of the script.
+    """
+    return security_row(KDVP_securities(root, ticker), 0)
+
+
 def sale(root, date: str, quantity: str, price: str) -> None:
-    """Add a Sale transaction into current Row."""
+    """Add a Sale transaction into current Row (quantity and price already formatted for eDavki)."""
     sale_elem = SubElement(root, "Sale")
     SubElement(sale_elem, "F6").text = date
-    SubElement(sale_elem, "F7").text = fmt_decimal(quantity, "typeDecimalPos12_8")
-    SubElement(sale_elem, "F9").text = fmt_decimal(price, "typeDecimalPos14_8")
+    SubElement(sale_elem, "F7").text = quantity
+    SubElement(sale_elem, "F9").text = price
     SubElement(sale_elem, "F10").text = "true"
 
 
 def purchase(root, date: str, quantity: str, price: str) -> None:
-    """Add a Purchase transaction into current Row."""
+    """Add a Purchase transaction into current Row (quantity and price already formatted for eDavki)."""
     purchase_elem = SubElement(root, "Purchase")
     SubElement(purchase_elem, "F1").text = date
     SubElement(purchase_elem, "F2").text = "B"
-    SubElement(purchase_elem, "F3").text = fmt_decimal(quantity, "typeDecimalPos12_8")
-    SubElement(purchase_elem, "F4").text = fmt_decimal(price, "typeDecimalPos14_8")
+    SubElement(purchase_elem, "F3").text = quantity
+    SubElement(purchase_elem, "F4").text = price
+
+
+def add_transactions(
+    root,
+    transactions: Sequence[Transaction],
+    state: dict,
+    securities_by_ticker: dict,
+    rounding: dict | None = None,
+    fifo: dict | None = None,
+) -> None:
+    """
+    Convert a batch of transactions to EUR and add them into root.
+    Quantities and prices are converted a column at a time (fixed-point).
+    Default: a new KDVPItem with Row ID=0 per transaction. Grouped output: the next
+    Row of the ticker's KDVPItem (securities_by_ticker keeps
+    [Securities, next row ID, holding, F8 elements with their holding]).
+    If rounding is given, rows are also added to the --fix-rounding-error totals,
+    if fifo is given, to the FIFO lot queues (--fifo).
+    """
+    quantities = units_column([tx.quantity for tx in transactions], "typeDecimalPos12_8")
+    qty_strs = fmt_units_column(quantities, "typeDecimalPos12_8")
+    prices = [eur_price_units(tx, state) for tx in transactions]
+    price_strs = fmt_units_column(prices, "typeDecimalPos14_8")
+
+    group_by_ticker = state["group_by_ticker"]
+    for tx, quantity, qty_str, price, price_str in zip(transactions, quantities, qty_strs, prices, price_strs):
+        date = parse_date(tx.time)
+
+        if group_by_ticker:
+            # One KDVPItem per ticker, rows numbered 0, 1, 2, ...
+            entry = securities_by_ticker.get(tx.ticker)
+            if entry is None:
+                entry = securities_by_ticker[tx.ticker] = [KDVP_securities(root, tx.ticker), 0, 0, []]
+            row_id = entry[1]
+            item = security_row(entry[0], row_id)
+            entry[1] += 1
+        else:
+            row_id = 0
+            item = KVDP_item(root, tx.ticker)
+
+        # "Market sell" -> sell, "Limit buy" -> buy, "Stop sell" -> sell
+        if tx.side == "buy":
+            purchase(item, date, qty_str, price_str)
+        elif tx.side == "sell":
+            sale(item, date, qty_str, price_str)
+
+        if group_by_ticker:
+            # F8 = holding after this row, summed from the 8-decimal quantities eDavki sees
+            entry[2] += quantity if tx.side == "buy" else -quantity
+            f8 = SubElement(item, "F8")
+            f8.text = fmt_units_column([entry[2]], "typeDecimalNeg12_8")[0]
+            if rounding is not None:
+                entry[3].append((f8, entry[2]))
+        else:
+            # F8 is included as 0 (eDavki UI calculates holdings itself)
+            SubElement(item, "F8").text = "0"
+
+        if rounding is not None:
+            track_rounding(rounding, tx, quantity, item, row_id)
+        if fifo is not None:
+            match_fifo(fifo, tx, price)
 
 
 def process_transactions(state: dict):
     """
     Build XML structure and write all transactions.
     We include only tickers that have at least one sell action.
+    Returns (envelope, number of transactions, rounding adjustments).
+    With --fifo, realized gains and open lots are in state["fifo"].
     """
     count = 0
 
@@ -501,59 +2140,1142 @@ def process_transactions(state: dict):
     }
 
     envelope = Element("Envelope", ns)
-    header_xml(envelope)
+    header_xml(envelope, state["taxpayer"])
     SubElement(envelope, "edp:AttachmentList")
     SubElement(envelope, "edp:Signatures")
 
     body = SubElement(envelope, "body")
     SubElement(body, "edp:bodyContent")
 
+    # Tickers with at least one sell are found while loading input files
+    tickers = state["tickers_with_sell"]
+    log(state, "Tickers with sale:", ", ".join(sorted(tickers)) if tickers else "/")
+
     doh = SubElement(body, "Doh_KDVP")
-    KDVP_metadata(doh)
+    KDVP_metadata(
+        doh, state["taxpayer"], state["year"], state["period"], len(tickers) if state["group_by_ticker"] else 0
+    )
 
-    # Decide which tickers we include
-    find_tickers_with_sell(state)
-    tickers = state["tickers_with_sell"]
-    print("Tickers with sale:", ", ".join(sorted(tickers)) if tickers else "/")
+    if state["jobs"] > 1:
+        count, adjustments = build_items_parallel(doh, state)
+        return envelope, count, adjustments
 
-    hi = state["header_indices"]
+    # Per ticker (grouped output): [Securities element, next row ID, holding, F8 elements]
+    securities_by_ticker: dict[str, list] = {}
+    # Per ticker running totals for --fix-rounding-error and FIFO lots (same pass as the XML)
+    rounding = {} if state["fix_rounding_error"] else None
+    fifo = state["fifo"]
 
-    # Stable output order
-    rows_sorted = sorted(state["rows"], key=lambda r: r[hi["Time"]])
+    # Stable output order (time, then file order)
+    stream = iter_transactions(state)
+    while batch := list(itertools.islice(stream, BATCH_SIZE)):
+        add_transactions(doh, batch, state, securities_by_ticker, rounding, fifo)
+        count += len(batch)
 
-    for row in rows_sorted:
-        action_full = row[hi["Action"]]
-        if action_full not in SUPPORTED_ACTIONS:
-            continue
+    adjustments = []
+    if rounding is not None:
+        with profile_stage(state, "finish_rounding") as stage:
+            adjustments = finish_rounding(rounding, securities_by_ticker)
+            stage["rows"] = len(adjustments)
+    if fifo is not None:
+        fifo["open_lots"] = open_lots(fifo)
+    return envelope, count, adjustments
 
-        ticker = row[hi["Ticker"]]
-        if ticker not in tickers:
-            continue
 
-        date = parse_date(row[hi["Time"]])
+# =========================
+# DIVIDENDS (--dividends)
+# =========================
+def route_dividend(dividend: Dividend, keys: tuple[str, str], state: dict, duplicates: set) -> bool:
+    """
+    Add a dividend of the report year to state["dividends"] unless an earlier file had it; True if added.
+    The line of a dropped duplicate is added to duplicates (the file's set in state["duplicates"]).
+    """
+    if not dividend.time.startswith(state["year"]):
+        return False
+    if is_duplicate(keys, state):
+        duplicates.add(dividend.line)
+        return False
+    state["dividends"].append(dividend)
+    return True
+
+
+def dividend_amounts(dividend: Dividend, state: dict) -> tuple[Decimal, Decimal]:
+    """Gross dividend and foreign (withholding) tax in EUR, rounded to cents."""
+    date = parse_date(dividend.time)
+    rates = state["rates"]
+    value = amount_to_eur(
+        dividend.quantity * dividend.price, dividend.currency, dividend.rate, dividend.base_currency, date, rates
+    )
+    tax = Decimal(0)
+    if dividend.withholding_tax:
+        # The export's exchange rate is for the dividend currency; tax in base currency needs none
+        if dividend.withholding_currency == dividend.currency:
+            rate = dividend.rate
+        elif dividend.withholding_currency == dividend.base_currency:
+            rate = Decimal(1)
+        else:
+            rate = None
+        tax = amount_to_eur(
+            dividend.withholding_tax, dividend.withholding_currency, rate, dividend.base_currency, date, rates
+        )
+    return value.quantize(CENTS, rounding=ROUND_HALF_UP), tax.quantize(CENTS, rounding=ROUND_HALF_UP)
+
+
+def isin_country(isin: str) -> str:
+    """Country code of an ISIN ("US0378331005" -> "US"), "" if there is no ISIN."""
+    return isin[:2] if len(isin) == 12 and isin[:2].isalpha() else ""
+
+
+def Doh_Div_metadata(root, taxpayer: Taxpayer, year: str) -> None:
+    """Add Doh_Div metadata required by eDavki."""
+    div_elem = SubElement(root, "Doh_Div")
+    SubElement(div_elem, "Period").text = year
+    SubElement(div_elem, "EmailAddress").text = taxpayer.email
+    SubElement(div_elem, "PhoneNumber").text = taxpayer.phone
+    SubElement(div_elem, "ResidentCountry").text = "SI"
+    SubElement(div_elem, "IsResident").text = "true"
+
+
+def dividend_xml(root, dividend: Dividend, value: Decimal, foreign_tax: Decimal) -> None:
+    """Add one Dividend element (the payer's address is not in the export, fill it in eDavki)."""
+    country = isin_country(dividend.isin)
+    div_elem = SubElement(root, "Dividend")
+    SubElement(div_elem, "Date").text = parse_date(dividend.time)
+    SubElement(div_elem, "PayerIdentificationNumber").text = dividend.isin or dividend.ticker
+    SubElement(div_elem, "PayerName").text = dividend.name or dividend.ticker
+    if country:
+        SubElement(div_elem, "PayerCountry").text = country
+    SubElement(div_elem, "Type").text = "1"  # dividends
+    SubElement(div_elem, "Value").text = format(value, "f")
+    SubElement(div_elem, "ForeignTax").text = format(foreign_tax, "f")
+    if country:
+        SubElement(div_elem, "SourceCountry").text = country
+    if foreign_tax and DIVIDEND_RELIEF_STATEMENT:
+        SubElement(div_elem, "ReliefStatement").text = DIVIDEND_RELIEF_STATEMENT
+
+
+def process_dividends(state: dict):
+    """
+    Build the Doh-Div XML from the dividend rows routed while scanning the CSV files
+    (report year, duplicates dropped), converted to EUR with the same rate tables as KDVP.
+    Returns (envelope, number of dividends).
+    """
+    ns = {
+        "xmlns": "http://edavki.durs.si/Documents/Schemas/Doh_Div_3.xsd",
+        "xmlns:edp": "http://edavki.durs.si/Documents/Schemas/EDP-Common-1.xsd",
+    }
+    envelope = Element("Envelope", ns)
+    header_xml(envelope, state["taxpayer"])
+    SubElement(envelope, "edp:AttachmentList")
+    SubElement(envelope, "edp:Signatures")
+
+    body = SubElement(envelope, "body")
+    SubElement(body, "edp:bodyContent")
+    Doh_Div_metadata(body, state["taxpayer"], state["year"])
 
-        eur_unit_price = compute_eur_unit_price(row, state)
-        price_str = fmt_decimal(eur_unit_price, "typeDecimalPos14_8")
+    # Stable order: time, then file order
+    dividends = sorted(state["dividends"], key=lambda dividend: dividend.time)
+    for dividend in dividends:
+        dividend_xml(body, dividend, *dividend_amounts(dividend, state))
+    return envelope, len(dividends)
 
-        qty_str = fmt_decimal(row[hi["No. of shares"]], "typeDecimalPos12_8")
 
-        item = KVDP_item(doh, ticker)
+# =========================
+# PARALLEL XML BUILDING (--jobs)
+# =========================
+# Depth of KDVPItem inside Envelope/body/Doh_KDVP
+KDVP_ITEM_DEPTH = 3
 
-        # "Market sell" -> sell, "Limit buy" -> buy, "Stop sell" -> sell
-        action = action_full.split()[1].lower()
-        if action == "buy":
-            purchase(item, date, qty_str, price_str)
-        elif action == "sell":
-            sale(item, date, qty_str, price_str)
+# Worker process state (rates are opened once per worker)
+_worker_state: dict = {}
+
+
+def init_worker(rate_folder: str, cache_folder: str, fix_rounding_error: bool, group_by_ticker: bool, fifo: bool) -> None:
+    """Process pool initializer: open rate tables (from the cache) once per worker."""
+    load_rates(rate_folder, _worker_state, cache_folder, verbose=False)
+    _worker_state["fix_rounding_error"] = fix_rounding_error
+    _worker_state["group_by_ticker"] = group_by_ticker
+    _worker_state["fifo"] = fifo
+
+
+def build_ticker_fragments(batch: list[tuple[str, list[tuple[int, Transaction]]]]) -> tuple[list, list, list, list]:
+    """
+    Build serialized KDVPItem fragments for a batch of tickers (runs in a worker).
+    Each fragment is returned with the stream position of its first transaction,
+    so the parent can write them in the same order as a serial run.
+    Rounding adjustments and open FIFO lots are returned with the position of the
+    ticker's first transaction, realized FIFO gains with the position of their sale.
+    """
+    fragments = []
+    adjustments = []
+    realized = []
+    lots = []
+    root = Element("Doh_KDVP")
+    for _, transactions in batch:
+        first_seq = transactions[0][0]
+        securities_by_ticker: dict[str, list] = {}
+        rounding = {} if _worker_state["fix_rounding_error"] else None
+        fifo = {"lots": {}, "realized": []} if _worker_state["fifo"] else None
+        add_transactions(root, [tx for _, tx in transactions], _worker_state, securities_by_ticker, rounding, fifo)
+        if rounding is not None:
+            adjustments.extend((first_seq, adj) for adj in finish_rounding(rounding, securities_by_ticker))
+        if fifo is not None:
+            sale_seq = {(tx.source, tx.line): seq for seq, tx in transactions}
+            realized.extend((sale_seq[(r.source, r.line)], r) for r in fifo["realized"])
+            lots.extend((first_seq, lot) for lot in open_lots(fifo))
+        if _worker_state["group_by_ticker"]:
+            fragments.append((transactions[0][0], "".join(pretty_lines(root[0], KDVP_ITEM_DEPTH))))
         else:
-            continue
+            for (seq, _), item in zip(transactions, root):
+                fragments.append((seq, "".join(pretty_lines(item, KDVP_ITEM_DEPTH))))
+        root.clear()
+    return fragments, adjustments, realized, lots
 
-        # F8 is included as 0 (eDavki UI calculates holdings itself)
-        SubElement(item, "F8").text = fmt_decimal("0", "typeDecimalNeg12_8")
 
+def build_items_parallel(doh, state: dict) -> tuple[int, list[RoundingAdjustment]]:
+    """
+    Partition transactions by ticker, build KDVPItem fragments in a process pool
+    and add them into doh in deterministic (serial run) order.
+    Returns (number of transactions, rounding adjustments).
+    """
+    by_ticker: dict[str, list[tuple[int, Transaction]]] = {}
+    count = 0
+    for seq, tx in enumerate(iter_transactions(state)):
+        by_ticker.setdefault(tx.ticker, []).append((seq, tx))
         count += 1
 
-    return envelope, count
+    # A few batches per worker, split by number of transactions
+    jobs = state["jobs"]
+    batch_size = max(1, count // (jobs * 4))
+    batches: list[list] = [[]]
+    batch_rows = 0
+    for ticker, transactions in by_ticker.items():
+        if batch_rows >= batch_size:
+            batches.append([])
+            batch_rows = 0
+        batches[-1].append((ticker, transactions))
+        batch_rows += len(transactions)
+
+    rates = state["rates"]
+    fragments: list[tuple[int, str]] = []
+    adjustments: list[tuple[int, RoundingAdjustment]] = []
+    realized: list[tuple[int, RealizedGain]] = []
+    lots: list[tuple[int, OpenLot]] = []
+    fifo = state["fifo"]
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=init_worker,
+        initargs=(
+            rates["rate_folder"],
+            rates["cache_folder"],
+            state["fix_rounding_error"],
+            state["group_by_ticker"],
+            fifo is not None,
+        ),
+    ) as pool:
+        for ticker_fragments, ticker_adjustments, ticker_realized, ticker_lots in pool.map(
+            build_ticker_fragments, batches
+        ):
+            fragments.extend(ticker_fragments)
+            adjustments.extend(ticker_adjustments)
+            realized.extend(ticker_realized)
+            lots.extend(ticker_lots)
+
+    fragments.sort(key=lambda fragment: fragment[0])
+    for _, text in fragments:
+        doh.append(Fragment(text))
+    adjustments.sort(key=lambda adjustment: adjustment[0])
+    if fifo is not None:
+        # Same order as a serial run: sales in stream order, lots by ticker first seen (sort is stable)
+        realized.sort(key=lambda gain: gain[0])
+        lots.sort(key=lambda lot: lot[0])
+        fifo["realized"] = [gain for _, gain in realized]
+        fifo["open_lots"] = [lot for _, lot in lots]
+    return count, [adj for _, adj in adjustments]
+
+
+# =========================
+# XSD VALIDATION (--validate)
+# =========================
+XS = "http://www.w3.org/2001/XMLSchema"
+XSI = "http://www.w3.org/2001/XMLSchema-instance"
+
+# Lexical forms of the XSD built-in types used by the eDavki schemas
+BUILTIN_PATTERNS = {
+    "boolean": re.compile(r"true|false|1|0"),
+    "date": re.compile(r"-?\d{4,}-\d{2}-\d{2}(Z|[+-]\d{2}:\d{2})?"),
+    "dateTime": re.compile(r"-?\d{4,}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:\d{2})?"),
+    "int": re.compile(r"[+-]?\d+"),
+    "integer": re.compile(r"[+-]?\d+"),
+    "positiveInteger": re.compile(r"[+-]?\d+"),
+    "decimal": re.compile(r"[+-]?(\d+(\.\d*)?|\.\d+)"),
+}
+NUMERIC_BUILTINS = {"int", "integer", "positiveInteger", "decimal"}
+
+# Facets compile_schema understands (anything else in a restriction is rejected)
+SIMPLE_FACETS = (
+    "pattern", "enumeration", "minInclusive", "maxInclusive", "totalDigits", "fractionDigits",
+    "maxLength", "minLength", "length",
+)
+
+# Errors reported before validation stops
+MAX_VALIDATION_ERRORS = 50
+
+
+class ValidationStopped(Exception):
+    """Raised inside the expat handlers after MAX_VALIDATION_ERRORS errors."""
+
+
+def read_xsd(path: str) -> tuple:
+    """Parse one XSD file; returns (root element, prefix -> namespace)."""
+    nsmap = {}
+    events = ElementTree.iterparse(path, events=("start-ns",))
+    for _, (prefix, uri) in events:
+        nsmap.setdefault(prefix, uri)
+    return events.root, nsmap
+
+
+def compile_schema(xsd_folder: str, main_xsd: str) -> dict:
+    """
+    Compile the XSD files (main_xsd and its imports) into plain dicts and tuples
+    (picklable, see load_schema). Supports the subset used by the eDavki schemas:
+    element/ref, complexType, sequence/choice/any with occurrences, simpleContent
+    with attributes, simpleType restrictions (pattern, enumeration, min/maxInclusive,
+    totalDigits, fractionDigits, length/minLength/maxLength) and xs:unique with
+    one-step paths. Any other construct raises ValueError instead of being
+    skipped, so a schema outside the subset never gives a wrong verdict.
+
+    schema["elements"]: qname -> (qname, type key (None = xs:anyType), nillable, unique constraints)
+    schema["types"]: key -> ("simple", builtin, facets)
+                         or ("complex", particle, child decls, attributes, text type key)
+    particle: ("element", qname, min, max) / ("any", namespaces, process, min, max)
+              / ("sequence" | "choice", particles, min, max); max None = unbounded
+    """
+    def tag_of(node) -> str:
+        return node.tag.split("}")[1] if node.tag.startswith(f"{{{XS}}}") else node.tag
+
+    def unsupported(node, where: str) -> ValueError:
+        return ValueError(
+            f"Unsupported XSD construct xs:{tag_of(node)} in {where} ({main_xsd}); --validate cannot check it."
+        )
+
+    def check_children(node, allowed: tuple, where: str) -> None:
+        for child in node:
+            if tag_of(child) not in allowed and tag_of(child) != "annotation":
+                raise unsupported(child, where)
+
+    documents = {}  # target namespace -> (root, nsmap)
+    pending = [main_xsd]
+    while pending:
+        root, nsmap = read_xsd(os.path.join(xsd_folder, pending.pop()))
+        check_children(root, ("import", "element", "simpleType", "complexType"), "schema")
+        documents[root.get("targetNamespace")] = (root, nsmap)
+        for imp in root.iter(f"{{{XS}}}import"):
+            if imp.get("namespace") not in documents and imp.get("schemaLocation"):
+                pending.append(imp.get("schemaLocation"))
+
+    types: dict = {}
+    elements: dict = {}
+    named = {}  # qname -> (node, tns, nsmap) of top-level simpleType / complexType
+    for tns, (root, nsmap) in documents.items():
+        for node in root:
+            if node.tag in (f"{{{XS}}}simpleType", f"{{{XS}}}complexType"):
+                named[f"{{{tns}}}{node.get('name')}"] = (node, tns, nsmap)
+
+    def qname(value: str, nsmap: dict) -> str:
+        prefix, _, local = value.rpartition(":")
+        return f"{{{nsmap.get(prefix, '')}}}{local}"
+
+    def occurs(node) -> tuple[int, int | None]:
+        max_occurs = node.get("maxOccurs", "1")
+        return int(node.get("minOccurs", "1")), None if max_occurs == "unbounded" else int(max_occurs)
+
+    def type_key(name: str, nsmap: dict) -> str:
+        key = qname(name, nsmap)
+        if key not in types:
+            if key.startswith(f"{{{XS}}}"):
+                types[key] = ("simple", key[len(XS) + 2:], {"patterns": []})
+            else:
+                if key not in named:
+                    raise ValueError(f"Unknown XSD type {name} ({main_xsd}); --validate cannot check it.")
+                node, tns, node_nsmap = named[key]
+                types[key] = None  # recursion guard
+                types[key] = compile_type(node, tns, node_nsmap)
+        return key
+
+    def anonymous(node, tns: str, nsmap: dict) -> str:
+        key = f"#{len(types)}"
+        types[key] = None
+        types[key] = compile_type(node, tns, nsmap)
+        return key
+
+    def compile_simple(node, nsmap: dict) -> tuple:
+        where = f"simpleType {node.get('name', '(anonymous)')}"
+        check_children(node, ("restriction",), where)  # no list / union
+        restriction = node.find(f"{{{XS}}}restriction")
+        if restriction is None or not restriction.get("base"):
+            raise ValueError(f"Unsupported XSD construct in {where} ({main_xsd}): restriction without base.")
+        check_children(restriction, SIMPLE_FACETS, where)
+        base = types[type_key(restriction.get("base"), nsmap)]
+        if base is None or base[0] != "simple":
+            raise ValueError(f"Unsupported XSD construct in {where} ({main_xsd}): base is not a simple type.")
+        _, builtin, base_facets = base
+        facets = {**base_facets, "patterns": list(base_facets["patterns"])}
+        patterns = []
+        for facet in restriction:
+            name, value = tag_of(facet), facet.get("value")
+            if name == "pattern":
+                patterns.append(re.compile(value))
+            elif name == "enumeration":
+                facets.setdefault("enumeration", set()).add(value)
+            elif name in ("minInclusive", "maxInclusive"):
+                facets[name] = Decimal(value)
+            elif name in ("totalDigits", "fractionDigits", "maxLength", "minLength", "length"):
+                facets[name] = int(value)
+        if patterns:
+            facets["patterns"].append(tuple(patterns))  # every derivation step must match
+        if "enumeration" in facets:
+            facets["enumeration"] = frozenset(facets["enumeration"])
+        return ("simple", builtin, facets)
+
+    def compile_particle(node, tns: str, nsmap: dict, decls: dict) -> tuple:
+        tag = tag_of(node)
+        if tag not in ("element", "any", "sequence", "choice"):
+            raise unsupported(node, "content model")  # xs:group, xs:all
+        min_occurs, max_occurs = occurs(node)
+        if tag == "element":
+            if node.get("ref"):
+                name = qname(node.get("ref"), nsmap)
+                decls[name] = None  # global declaration
+            else:
+                name = f"{{{tns}}}{node.get('name')}"
+                decls[name] = compile_element(node, tns, nsmap)
+            return ("element", name, min_occurs, max_occurs)
+        if tag == "any":
+            namespaces = frozenset(node.get("namespace", "##any").split())
+            return ("any", namespaces, node.get("processContents", "strict"), min_occurs, max_occurs)
+        particles = tuple(compile_particle(child, tns, nsmap, decls) for child in node if tag_of(child) != "annotation")
+        return (tag, particles, min_occurs, max_occurs)
+
+    def compile_type(node, tns: str, nsmap: dict) -> tuple:
+        if node.tag == f"{{{XS}}}simpleType":
+            return compile_simple(node, nsmap)
+        where = f"complexType {node.get('name', '(anonymous)')}"
+        # Attributes directly on complexType, complexContent, xs:all, xs:group ... are not supported
+        check_children(node, ("sequence", "choice", "simpleContent"), where)
+        if node.get("mixed") == "true":
+            raise ValueError(f"Unsupported XSD construct in {where} ({main_xsd}): mixed content.")
+        particle, decls, attributes, text_type = None, {}, {}, None
+        for child in node:
+            tag = tag_of(child)
+            if tag in ("sequence", "choice"):
+                particle = compile_particle(child, tns, nsmap, decls)
+            elif tag == "simpleContent":
+                check_children(child, ("extension",), where)  # no restriction
+                extension = child.find(f"{{{XS}}}extension")
+                check_children(extension, ("attribute",), where)  # no attributeGroup / anyAttribute
+                text_type = type_key(extension.get("base"), nsmap)
+                for attribute in extension.iter(f"{{{XS}}}attribute"):
+                    check_children(attribute, (), f"attribute {attribute.get('name')}")  # inline simpleType
+                    if attribute.get("ref") or attribute.get("fixed") is not None:
+                        raise ValueError(f"Unsupported XSD construct in {where} ({main_xsd}): attribute ref / fixed.")
+                    attributes[attribute.get("name")] = (
+                        type_key(attribute.get("type", "xs:string"), nsmap),
+                        attribute.get("use") == "required",
+                    )
+        return ("complex", particle, decls, attributes, text_type)
+
+    def compile_element(node, tns: str, nsmap: dict) -> tuple:
+        name = f"{{{tns}}}{node.get('name')}"
+        where = f"element {node.get('name')}"
+        check_children(node, ("complexType", "simpleType", "unique"), where)  # no key / keyref
+        for unsupported_attribute in ("substitutionGroup", "fixed", "abstract"):
+            if node.get(unsupported_attribute) is not None:
+                raise ValueError(f"Unsupported XSD construct in {where} ({main_xsd}): {unsupported_attribute}.")
+        for constraint in node.findall(f"{{{XS}}}unique"):
+            for path in (constraint.find(f"{{{XS}}}selector"), constraint.find(f"{{{XS}}}field")):
+                if path is None or any(c in path.get("xpath", "/") for c in "/|.@*"):
+                    raise ValueError(f"Unsupported XSD construct in {where} ({main_xsd}): xs:unique path.")
+        if node.get("type"):
+            key = type_key(node.get("type"), nsmap)
+        else:
+            inline = node.find(f"{{{XS}}}complexType")
+            if inline is None:
+                inline = node.find(f"{{{XS}}}simpleType")
+            key = anonymous(inline, tns, nsmap) if inline is not None else None  # xs:anyType
+        unique = tuple(
+            (
+                constraint.get("name"),
+                qname(constraint.find(f"{{{XS}}}selector").get("xpath"), nsmap),
+                qname(constraint.find(f"{{{XS}}}field").get("xpath"), nsmap),
+            )
+            for constraint in node.findall(f"{{{XS}}}unique")
+        )
+        return (name, key, node.get("nillable") == "true", unique)
+
+    for tns, (root, nsmap) in documents.items():
+        for node in root.findall(f"{{{XS}}}element"):
+            elements[f"{{{tns}}}{node.get('name')}"] = compile_element(node, tns, nsmap)
+    return {"elements": elements, "types": types}
+
+
+def xsd_fingerprint(xsd_folder: str) -> list:
+    """Name, size and mtime of the XSD files (the cached schema is rebuilt when they change)."""
+    fingerprint = [XSD_CACHE_VERSION]
+    for filename in sorted(f for f in get_files(xsd_folder) if f.lower().endswith(".xsd")):
+        st = os.stat(os.path.join(xsd_folder, filename))
+        fingerprint.append([filename, st.st_size, st.st_mtime_ns])
+    return fingerprint
+
+
+def load_schema(xsd_folder: str = XSD_FOLDER, main_xsd: str = XSD_MAIN_FILE) -> dict:
+    """Compiled schema from the cache (pickle next to the XSD files), compiled and cached on first use."""
+    fingerprint = xsd_fingerprint(xsd_folder)
+    cache_path = os.path.join(xsd_folder, "cache", f"{os.path.splitext(main_xsd)[0]}.pickle")
+    try:
+        with open(cache_path, "rb") as f:
+            cached = pickle.load(f)
+        if cached["fingerprint"] == fingerprint:
+            return cached["schema"]
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError):
+        pass
+
+    schema = compile_schema(xsd_folder, main_xsd)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "wb") as f:
+            pickle.dump({"fingerprint": fingerprint, "schema": schema}, f, pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass  # read-only folder: compile again next time
+    return schema
+
+
+def check_simple_value(value: str, simple_type: tuple) -> str | None:
+    """Return an error message if value does not match the simple type, else None."""
+    _, builtin, facets = simple_type
+    if builtin != "string":
+        value = " ".join(value.split())  # whiteSpace="collapse"
+        pattern = BUILTIN_PATTERNS.get(builtin)
+        if pattern is not None and not pattern.fullmatch(value):
+            return f"'{value}' is not a valid xs:{builtin}"
+        if builtin == "date":
+            try:
+                datetime.date.fromisoformat(value[:10])
+            except ValueError:
+                return f"'{value}' is not a valid xs:date"
+
+    for alternatives in facets["patterns"]:
+        if not any(p.fullmatch(value) for p in alternatives):
+            return f"'{value}' does not match pattern {' | '.join(p.pattern for p in alternatives)}"
+    if "enumeration" in facets and value not in facets["enumeration"]:
+        return f"'{value}' is not one of {', '.join(sorted(facets['enumeration']))}"
+    if "maxLength" in facets and len(value) > facets["maxLength"]:
+        return f"'{value}' is longer than {facets['maxLength']} characters"
+    if "minLength" in facets and len(value) < facets["minLength"]:
+        return f"'{value}' is shorter than {facets['minLength']} characters"
+    if "length" in facets and len(value) != facets["length"]:
+        return f"'{value}' is not {facets['length']} characters long"
+
+    if builtin in NUMERIC_BUILTINS:
+        number = Decimal(value)
+        if builtin == "int" and not -2 ** 31 <= number < 2 ** 31:
+            return f"'{value}' is out of xs:int range"
+        if builtin == "positiveInteger" and number <= 0:
+            return f"'{value}' is not a positive integer"
+        if "minInclusive" in facets and number < facets["minInclusive"]:
+            return f"'{value}' is less than {facets['minInclusive']}"
+        if "maxInclusive" in facets and number > facets["maxInclusive"]:
+            return f"'{value}' is greater than {facets['maxInclusive']}"
+        _, digits, exponent = number.normalize().as_tuple()
+        fraction_digits = max(0, -exponent)
+        total_digits = len(digits) + exponent if exponent > 0 else max(len(digits), fraction_digits)
+        if "fractionDigits" in facets and fraction_digits > facets["fractionDigits"]:
+            return f"'{value}' has more than {facets['fractionDigits']} fraction digits"
+        if "totalDigits" in facets and total_digits > facets["totalDigits"]:
+            return f"'{value}' has more than {facets['totalDigits']} digits"
+    return None
+
+
+def match_particle(particle: tuple, names: list[str], positions: set[int]) -> set[int]:
+    """
+    Positions in names reachable after matching particle from any of positions
+    (a set of positions instead of backtracking keeps it linear in the number of children).
+    """
+    kind, min_occurs, max_occurs = particle[0], particle[-2], particle[-1]
+    reached = set(positions) if min_occurs == 0 else set()
+    current = positions
+    count = 0
+    while current and (max_occurs is None or count < max_occurs):
+        if kind == "element":
+            step = {p + 1 for p in current if p < len(names) and names[p] == particle[1]}
+        elif kind == "any":
+            step = {p + 1 for p in current if p < len(names) and namespace_allowed(names[p], particle[1])}
+        elif kind == "sequence":
+            step = current
+            for child in particle[1]:
+                step = match_particle(child, names, step)
+        else:  # choice
+            step = set().union(*(match_particle(child, names, current) for child in particle[1]))
+        count += 1
+        if count >= min_occurs:
+            if step <= reached:
+                break  # nothing new (also stops empty repetitions)
+            reached |= step
+        current = step
+    return reached
+
+
+def namespace_allowed(name: str, namespaces: frozenset) -> bool:
+    """xs:any namespace check for a {namespace}local name."""
+    return "##any" in namespaces or name[1:].split("}")[0] in namespaces
+
+
+def validate_xml(path: str, schema: dict) -> list[str]:
+    """
+    Validate an XML file against the compiled schema without building a tree:
+    expat events drive a stack of open elements, each keeping only its child
+    names (for the content model) and text of simple-typed elements.
+    Returns error messages ("line N: ..."), empty if the document is valid.
+    """
+    types = schema["types"]
+    elements = schema["elements"]
+    errors: list[str] = []
+    # Open elements: [name, decl (None = not validated), child names, text parts (None = element-only),
+    # values per xs:unique constraint]
+    stack: list[list] = []
+    parser = expat.ParserCreate(namespace_separator="}")
+
+    def error(message: str) -> None:
+        errors.append(f"line {parser.CurrentLineNumber}: {message}")
+        if len(errors) >= MAX_VALIDATION_ERRORS:
+            raise ValidationStopped
+
+    def local(name: str) -> str:
+        return name.rsplit("}", 1)[-1]
+
+    def start(name: str, attributes: dict) -> None:
+        name = "{" + name if "}" in name else name
+        decl = None
+        if not stack:
+            decl = elements.get(name)
+            if decl is None:
+                error(f"unknown root element {local(name)}")
+        elif stack[-1][1] is not None:
+            parent_type = types[stack[-1][1][1]]
+            if parent_type[0] == "complex" and name in parent_type[2]:
+                decl = parent_type[2][name] or elements.get(name)
+                stack[-1][2].append(name)
+            elif parent_type[0] == "complex" and parent_type[1] is not None and any_allowed(parent_type[1], name):
+                decl = elements.get(name)  # processContents lax: validate only known elements
+                stack[-1][2].append(name)
+            else:
+                error(f"element {local(name)} is not allowed in {local(stack[-1][0])}")
+        if decl is not None and decl[1] is None:
+            decl = None  # xs:anyType: any content
+        if decl is not None:
+            element_type = types[decl[1]]
+            declared = element_type[3] if element_type[0] == "complex" else {}
+            for attribute, value in attributes.items():
+                if attribute.startswith(XSI + "}"):
+                    continue
+                if attribute not in declared:
+                    error(f"attribute {attribute} is not allowed in {local(name)}")
+                else:
+                    message = check_simple_value(value, types[declared[attribute][0]])
+                    if message:
+                        error(f"{local(name)}/@{attribute}: {message}")
+            for attribute, (_, required) in declared.items():
+                if required and attribute not in attributes:
+                    error(f"{local(name)}: missing required attribute {attribute}")
+            nil = attributes.get(XSI + "}nil") in ("true", "1")
+            if nil and not decl[2]:
+                error(f"{local(name)} is not nillable")
+            decl = decl if not nil else None
+
+        if decl is None:
+            stack.append([name, None, [], None, None])
+        else:
+            element_type = types[decl[1]]
+            has_text = element_type[0] == "simple" or element_type[4] is not None
+            stack.append([name, decl, [], [] if has_text else None, {c[0]: set() for c in decl[3]}])
+
+    def text(data: str) -> None:
+        if not stack or stack[-1][1] is None:
+            return
+        if stack[-1][3] is not None:
+            stack[-1][3].append(data)
+        elif data.strip():
+            error(f"{local(stack[-1][0])}: text is not allowed here")
+
+    def end(_name: str) -> None:
+        name, decl, children, parts, _ = stack.pop()
+        if decl is None:
+            return
+        element_type = types[decl[1]]
+        value = "".join(parts) if parts is not None else ""
+        if parts is not None:
+            simple_type = element_type if element_type[0] == "simple" else types[element_type[4]]
+            message = check_simple_value(value, simple_type)
+            if message:
+                error(f"{local(name)}: {message}")
+        if element_type[0] == "complex":
+            particle = element_type[1]
+            valid = len(children) in match_particle(particle, children, {0}) if particle else not children
+            if not valid:
+                shown = ", ".join(local(c) for c in children[:10]) + (", ..." if len(children) > 10 else "")
+                error(f"{local(name)}: unexpected content ({shown or 'empty'})")
+
+        # xs:unique: this element is a field of a selected child of the element with the constraint
+        if len(stack) >= 2 and stack[-2][4]:
+            scope = stack[-2]
+            for constraint, selector, field in scope[1][3]:
+                if stack[-1][0] == selector and name == field:
+                    if value in scope[4][constraint]:
+                        error(f"{local(scope[0])}: duplicate {local(field)} '{value}' ({constraint})")
+                    scope[4][constraint].add(value)
+
+    def any_allowed(particle: tuple, name: str) -> bool:
+        if particle[0] == "any":
+            return namespace_allowed(name, particle[1])
+        if particle[0] in ("sequence", "choice"):
+            return any(any_allowed(child, name) for child in particle[1])
+        return False
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = text
+    parser.buffer_text = True
+    try:
+        with open(path, "rb") as f:
+            parser.ParseFile(f)
+    except ValidationStopped:
+        errors.append(f"validation stopped after {MAX_VALIDATION_ERRORS} errors")
+    except expat.ExpatError as err:
+        errors.append(f"XML is not well-formed: {err}")
+    return errors
+
+
+# =========================
+# PROFILING (--profile)
+# =========================
+def new_profile(trace_memory: bool = False) -> dict:
+    """
+    Empty profile: finished stages (in start order), counters and the stack of running stages.
+    trace_memory also records peak Python allocations per stage (tracemalloc must be started; slow).
+    """
+    return {
+        "stages": [],
+        "counters": {
+            "fx_lookups": 0,  # official (ECB) rate lookups
+            "fx_gap_lookups": 0,  # ... on days without a quote (weekends, holidays)
+            "fx_backward_steps": 0,  # days a day-by-day backward search would step back (tables answer at once)
+            "fx_export_rate": 0,  # conversions with the Trading 212 exchange rate (no official rate)
+            "fx_cache_hits": 0,  # non-EUR prices already converted in the input cache (--cache)
+            "fx_cache_misses": 0,  # non-EUR prices converted in this run
+        },
+        "running": [],
+        "trace_memory": trace_memory,
+        "quote_days": None,
+    }
+
+
+def peak_rss() -> int | None:
+    """Peak resident memory of this process in bytes (None where not available)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+@contextlib.contextmanager
+def profile_stage(state: dict, name: str) -> Iterator[dict]:
+    """
+    Record wall time and peak RSS of the process at the end of one stage (only with --profile);
+    with --profile-memory also the peak traced memory, which includes nested stages.
+    The yielded dict takes extra fields, e.g. rows.
+    """
+    profile = state["profile"]
+    stage = {"name": name}
+    if profile is None:
+        yield stage
+        return
+
+    running = profile["running"]
+    trace_memory = profile["trace_memory"]
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        for outer in running:
+            outer["traced_peak"] = max(outer["traced_peak"], peak)
+        tracemalloc.reset_peak()
+        stage["traced_peak"] = 0
+    stage["depth"] = len(running)
+    profile["stages"].append(stage)
+    running.append(stage)
+    start = time.perf_counter()
+    try:
+        yield stage
+    finally:
+        stage["seconds"] = time.perf_counter() - start
+        stage["rss_peak"] = peak_rss()
+        if trace_memory:
+            stage["traced_peak"] = max(stage["traced_peak"], tracemalloc.get_traced_memory()[1])
+        running.pop()
+
+
+def quote_days(rates: dict) -> dict[str, bytes]:
+    """
+    Bitmaps of days with a published rate per currency (bit i = first_ordinal + i),
+    recorded when the tables were built: from built tables or the <CUR>.days cache files.
+    """
+    quoted = {currency: table.quoted for currency, table in rates["tables"].items() if table.quoted is not None}
+    for currency in rates["index"]:
+        if currency not in quoted:
+            with open(os.path.join(rates["cache_folder"], f"{currency}.days"), "rb") as f:
+                quoted[currency] = f.read()
+    return quoted
+
+
+def count_fx(tx: Transaction, state: dict) -> None:
+    """Count how the EUR price of one transaction is found (same decisions as compute_eur_unit_price)."""
+    profile = state["profile"]
+    counters = profile["counters"]
+    if tx.currency == "EUR":
+        return
+    if tx.eur_price is not None:
+        counters["fx_cache_hits"] += 1
+        return
+    counters["fx_cache_misses"] += 1
+
+    rates = state["rates"]
+    table = get_rate_table(rates, CURRENCY_SUBUNITS.get(tx.currency, (tx.currency,))[0])
+    if table is None:
+        counters["fx_export_rate"] += 1
+        if tx.base_currency == "EUR":
+            return
+        table = get_rate_table(rates, tx.base_currency)
+        if table is None:
+            return  # conversion fails with "Unsupported base currency"
+
+    if profile["quote_days"] is None:
+        profile["quote_days"] = quote_days(rates)
+    quoted = profile["quote_days"][table.currency]
+    index = datetime.date.fromisoformat(parse_date(tx.time)).toordinal() - table.first_ordinal
+    counters["fx_lookups"] += 1
+    if index < 0:
+        return  # before the first rate (conversion fails)
+    # Tables end on a quoted day, so later days step back to the last one
+    steps = max(0, index - (len(table.values) - 1))
+    index -= steps
+    while not quoted[index >> 3] >> (index & 7) & 1:
+        index -= 1
+        steps += 1
+    if steps:
+        counters["fx_gap_lookups"] += 1
+        counters["fx_backward_steps"] += steps
+
+
+def profile_transactions(stream: Iterator[Transaction], state: dict) -> Iterator[Transaction]:
+    """Pass transactions through and count FX lookups (with --profile)."""
+    for tx in stream:
+        count_fx(tx, state)
+        yield tx
+
+
+def memory_mb(value: int | None) -> float | None:
+    """Bytes as MB (rounded), None stays None."""
+    return None if value is None else round(value / (1024 * 1024), 3)
+
+
+def print_profile(profile: dict) -> None:
+    """Print stage timings and FX counters as a table."""
+    trace_memory = profile["trace_memory"]
+    print("Profile:")
+    header = f"  {'stage':28s} {'seconds':>9s} {'rows':>10s} {'RSS MB':>9s}"
+    print(header + (f" {'traced MB':>10s}" if trace_memory else ""))
+    for stage in profile["stages"]:
+        name = "  " * stage["depth"] + stage["name"]
+        rows = "" if stage.get("rows") is None else str(stage["rows"])
+        rss = "n/a" if stage["rss_peak"] is None else f"{memory_mb(stage['rss_peak']):.1f}"
+        traced = f" {memory_mb(stage['traced_peak']):10.1f}" if trace_memory else ""
+        print(f"  {name:28s} {stage['seconds']:9.3f} {rows:>10s} {rss:>9s}{traced}")
+    for name, value in profile["counters"].items():
+        print(f"  {name:28s} {value:>9d}")
+
+
+def profile_report(profile: dict) -> dict:
+    """Profile as plain JSON data (memory in MB)."""
+    stages = []
+    for stage in profile["stages"]:
+        report = {k: v for k, v in stage.items() if k not in ("rss_peak", "traced_peak")}
+        report["rss_peak_mb"] = memory_mb(stage["rss_peak"])
+        if "traced_peak" in stage:
+            report["traced_peak_mb"] = memory_mb(stage["traced_peak"])
+        stages.append(report)
+    return {"stages": stages, "counters": profile["counters"]}
+
+
+# =========================
+# LIBRARY API
+# =========================
+class Conversion(NamedTuple):
+    """Result of convert()."""
+    xml: Iterator[str]  # pretty printed XML, streamed line by line
+    count: int
+    rounding_adjustments: list[RoundingAdjustment]
+    realized_gains: list[RealizedGain]  # Options(fifo=True)
+    open_lots: list[OpenLot]
+    dividends_xml: Iterator[str] | None = None  # Doh-Div XML, Options(dividends=True)
+    dividend_count: int = 0
+
+
+def settings_taxpayer() -> Taxpayer:
+    """Taxpayer from the USER SETTINGS at the top of this file."""
+    return Taxpayer(TAX_NUMBER, FULL_NAME, ADDRESS, CITY, POST_NUMBER, BIRTH_DATE, EMAIL, PHONE)
+
+
+def new_state(taxpayer: Taxpayer, year: str, options: Options, period: tuple[str, str] | None = None) -> dict:
+    """Fresh state of one conversion."""
+    return {
+        "rates": None,
+        "input_folder": INPUT_FOLDER,
+        "input_files": [],
+        "unsorted_files": set(),
+        "tickers_with_sell": set(),
+        "layouts": {},
+        "base_currencies": {},
+        "cache": None,
+        "cached_files": {},
+        "seen_ids": set(),
+        "seen_trades": set(),
+        "seen_trades_without_id": set(),
+        "duplicates": {},
+        "rows_scanned": 0,
+        "taxpayer": taxpayer,
+        "year": year,
+        "period": period or (f"{year}-01-01", f"{year}-12-31"),
+        # --year: tickers need a sell in the report year, later rows are dropped ("Time" prefix checks)
+        "sell_year": year if options.filter_year else None,
+        "year_end": str(int(year) + 1) if options.filter_year else None,
+        "fix_rounding_error": options.fix_rounding_error,
+        "group_by_ticker": options.group_by_ticker,
+        "jobs": max(1, options.jobs),
+        "verbose": options.verbose,
+        "fifo": {"lots": {}, "realized": [], "open_lots": []} if options.fifo else None,
+        "dividends": [] if options.dividends else None,  # dividend rows of the report year (--dividends)
+        "corporate_actions": None,  # splits / renames (load_corporate_actions())
+        "profile": None,  # --profile (new_profile())
+        "trades": None,  # --import-trades (open_trades_file())
+        "trades_export": None,  # --export-trades (new_trade_columns())
+    }
+
+
+def convert(
+    inputs: str | Sequence[str],
+    taxpayer: Taxpayer,
+    year: str,
+    options: Options = Options(),
+    rates: dict | None = None,
+) -> Conversion:
+    """
+    Convert Trading 212 CSV exports into Doh_KDVP XML.
+    inputs is a folder with CSV files or a list of CSV file paths. Pass rates
+    (state["rates"] from load_rates) to reuse already loaded rate tables.
+
+        result = convert("input", taxpayer, "2024")
+        save_file(result.xml, "output", "output.xml")
+    """
+    state = new_state(taxpayer, str(year), options)
+    if rates is None:
+        load_rates(options.rate_folder, state, verbose=options.verbose)
+    else:
+        state["rates"] = rates
+
+    if options.corporate_actions_file:
+        load_corporate_actions(options.corporate_actions_file, state)
+    if options.cache_file:
+        state["cache"] = open_input_cache(options.cache_file, state["rates"], state["corporate_actions"])
+    try:
+        if isinstance(inputs, str):
+            load_input_files(inputs, state)
+        else:
+            load_input_files("", state, inputs)
+        envelope, count, adjustments = process_transactions(state)
+    finally:
+        if state["cache"] is not None:
+            state["cache"].close()
+
+    fifo = state["fifo"] or {"realized": [], "open_lots": []}
+    dividends_xml, dividend_count = None, 0
+    if state["dividends"] is not None:
+        dividends_envelope, dividend_count = process_dividends(state)
+        dividends_xml = prettify(dividends_envelope)
+    return Conversion(
+        prettify(envelope), count, adjustments, fifo["realized"], fifo["open_lots"], dividends_xml, dividend_count
+    )
+
+
+# =========================
+# SERVICE (--serve / --http)
+# =========================
+# Service worker state (rate tables stay loaded between conversions, per rate folder)
+_service_state: dict = {"rates": {}}
+
+
+def init_service_worker(rate_folder: str) -> None:
+    """Process pool initializer: load the default rates once per service worker (if the folder exists)."""
+    if os.path.isdir(rate_folder):
+        service_rates(rate_folder)
+
+
+def service_rates(rate_folder: str) -> dict:
+    """Rate tables of rate_folder, loaded on the first request that uses the folder."""
+    key = os.path.abspath(rate_folder)
+    if key not in _service_state["rates"]:
+        state: dict = {}
+        load_rates(rate_folder, state, verbose=False)
+        _service_state["rates"][key] = state["rates"]
+    return _service_state["rates"][key]
+
+
+def service_path(root: str, path: str) -> str:
+    """Resolve a request path against the service root (--root); paths outside it are rejected."""
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise ValueError(f"Path is outside the service root: {path}")
+    return resolved
+
+
+def handle_request(request: dict, root: str) -> dict:
+    """
+    Run one conversion request in a service worker. Request (JSON):
+    {"inputs": folder or [paths], "taxpayer": {...}, "year": "2024", "options": {...}, "output": path}
+    taxpayer and year default to USER SETTINGS. Without "output" the XML is returned in the response.
+    With "options": {"dividends": true} the Doh-Div XML goes to "dividends_output" (or the response).
+    All paths (inputs, outputs and file/folder options) are relative to root and must stay inside it.
+    """
+    taxpayer = Taxpayer(**request["taxpayer"]) if "taxpayer" in request else settings_taxpayer()
+    # Conversions already run in parallel (one per worker)
+    options = Options(**{**request.get("options", {}), "jobs": 1, "verbose": False})
+    options = options._replace(
+        **{
+            field: service_path(root, getattr(options, field))
+            for field in ("rate_folder", "cache_file", "corporate_actions_file")
+            if getattr(options, field)
+        }
+    )
+    if isinstance(request["inputs"], str):
+        inputs = service_path(root, request["inputs"])
+    else:
+        inputs = [service_path(root, path) for path in request["inputs"]]
+    output = service_path(root, request["output"]) if request.get("output") else None
+    dividends_output = service_path(root, request["dividends_output"]) if request.get("dividends_output") else None
+
+    rates = service_rates(options.rate_folder)
+    result = convert(inputs, taxpayer, str(request.get("year", TAX_YEAR)), options, rates)
+
+    response = {
+        "count": result.count,
+        "rounding_adjustments": [
+            {**adj._asdict(), "diff": format(adj.diff, "f"), "quantity": format(adj.quantity, "f")}
+            for adj in result.rounding_adjustments
+        ],
+    }
+    if output:
+        folder, filename = os.path.split(output)
+        response["output"] = save_file(result.xml, folder, filename)
+    else:
+        response["xml"] = "".join(result.xml)
+    if result.dividends_xml is not None:
+        response["dividend_count"] = result.dividend_count
+        if dividends_output:
+            folder, filename = os.path.split(dividends_output)
+            response["dividends_output"] = save_file(result.dividends_xml, folder, filename)
+        else:
+            response["dividends_xml"] = "".join(result.dividends_xml)
+    return response
+
+
+def serve_json_lines(pool: ProcessPoolExecutor, root: str, stdin, stdout) -> None:
+    """
+    Read one JSON request per line from stdin and write one JSON response per line
+    to stdout as conversions finish ("id" from the request is copied to the response).
+    """
+    lock = threading.Lock()
+
+    def respond(request_id, future) -> None:
+        try:
+            response = {"id": request_id, "ok": True, **future.result()}
+        except Exception as err:
+            response = {"id": request_id, "ok": False, "error": str(err)}
+        with lock:
+            stdout.write(json.dumps(response) + "\n")
+            stdout.flush()
+
+    for line in stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as err:
+            with lock:
+                stdout.write(json.dumps({"id": None, "ok": False, "error": f"Invalid JSON: {err}"}) + "\n")
+                stdout.flush()
+            continue
+        future = pool.submit(handle_request, request, root)
+        future.add_done_callback(functools.partial(respond, request.get("id")))
+
+
+def serve_http(pool: ProcessPoolExecutor, root: str, port: int) -> None:
+    """
+    Local HTTP service: POST a JSON request (see handle_request), get a JSON response.
+    Only "Content-Type: application/json" requests addressed to 127.0.0.1/localhost are
+    accepted: browsers send those cross-origin only after a CORS preflight (which is
+    not answered), and the Host check stops DNS rebinding.
+    """
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            host = self.headers.get("Host", "").rsplit(":", 1)[0]
+            if host not in ("127.0.0.1", "localhost"):
+                self.send_json({"ok": False, "error": f"Host not allowed: {host}"}, 403)
+                return
+            if self.headers.get_content_type() != "application/json":
+                self.send_json({"ok": False, "error": "Content-Type must be application/json"}, 415)
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                response, status = {"ok": True, **pool.submit(handle_request, request, root).result()}, 200
+            except Exception as err:
+                response, status = {"ok": False, "error": str(err)}, 400
+            self.send_json(response, status)
+
+        def send_json(self, response: dict, status: int) -> None:
+            body = json.dumps(response).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    with ThreadingHTTPServer(("127.0.0.1", port), RequestHandler) as server:
+        print(f"Listening on http://127.0.0.1:{port}/", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def serve(args) -> None:
+    """Start the service; rate tables are loaded once per worker process."""
+    jobs = args.jobs or os.cpu_count() or 1
+    root = os.path.realpath(args.root)
+    rate_folder = os.path.join(root, RATE_FOLDER)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_service_worker, initargs=(rate_folder,)) as pool:
+        if args.http is not None:
+            serve_http(pool, root, args.http)
+        else:
+            serve_json_lines(pool, root, sys.stdin, sys.stdout)
 
 
 # =========================
@@ -567,40 +3289,222 @@ def parse_args():
         action="store_true",
         help="Fix tiny leftovers caused by rounding to 8 decimals (prints what was changed).",
     )
+    parser.add_argument(
+        "--group-by-ticker",
+        action="store_true",
+        help="Write one KDVPItem per ticker with numbered rows and running holdings (F8).",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help=(
+            "Convert and build XML per ticker in N worker processes (output is the same as with 1). "
+            "With --serve/--http: number of conversions run at the same time (default: CPU count)."
+        ),
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help=f"Keep parsed and EUR-converted transactions in {INPUT_CACHE_FILE}; only new or changed files are parsed.",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Service mode: read JSON conversion requests from stdin (one per line), write JSON responses to stdout.",
+    )
+    parser.add_argument(
+        "--http",
+        type=int,
+        metavar="PORT",
+        help="Service mode: accept JSON conversion requests over HTTP on 127.0.0.1:PORT.",
+    )
+    parser.add_argument(
+        "--root",
+        metavar="FOLDER",
+        default=".",
+        help="Service mode: request paths (inputs, outputs, rate folder) are relative to FOLDER and must stay inside it.",
+    )
+    parser.add_argument(
+        "--fifo",
+        action="store_true",
+        help=(
+            f"Match sales to purchases (FIFO) and write realized EUR gains with holding periods "
+            f"({FIFO_GAINS_FILENAME}) and open lots ({FIFO_LOTS_FILENAME}) into the output folder."
+        ),
+    )
+    parser.add_argument(
+        "--dividends",
+        action="store_true",
+        help=(
+            f"Also write dividends of the report year as Doh-Div XML ({DIVIDENDS_FILENAME}); "
+            "dividend rows are picked up in the same CSV pass."
+        ),
+    )
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help=f"Validate the written XML against the bundled {XSD_FOLDER}/{XSD_MAIN_FILE} (offline).",
+    )
+    parser.add_argument(
+        "--year",
+        type=int,
+        help=(
+            "Report year (instead of TAX_YEAR): only tickers with a sale in this year are included, "
+            "rows after it are dropped while reading CSV."
+        ),
+    )
+    parser.add_argument(
+        "--corporate-actions",
+        metavar="FILE",
+        help=(
+            f"Table of stock splits and ticker renames (CSV) applied to earlier trades "
+            f"(default: {CORPORATE_ACTIONS_FILE} if it exists)."
+        ),
+    )
+    parser.add_argument(
+        "--export-trades",
+        metavar="FILE",
+        help="Also write the normalized, EUR-converted trades of this run into FILE (compact columnar file).",
+    )
+    parser.add_argument(
+        "--import-trades",
+        metavar="FILE",
+        help="Build XML from a file written by --export-trades instead of the input CSV files (no parsing).",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print wall time, rows and peak RSS per stage, and FX lookup counters.",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="Also record peak Python allocations per stage with tracemalloc (implies --profile; much slower).",
+    )
+    parser.add_argument(
+        "--profile-json",
+        metavar="FILE",
+        help="Write the --profile results as JSON into FILE (implies --profile).",
+    )
+    parser.add_argument(
+        "--profile-stats",
+        metavar="FILE",
+        help="Run under cProfile and dump the stats into FILE (view with: python -m pstats FILE).",
+    )
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
-
-    state = {
-        "usd_eur": {},
-        "rows": [],
-        "tickers_with_sell": set(),
-        "base_currency": "EUR",
-        "header_indices": {},
-        "fix_rounding_error": bool(args.fix_rounding_error),
-    }
-
-    # Load input CSV files and rate files
-    load_input_files(INPUT_FOLDER, state)
-    load_usd_eur_rates(RATE_FOLDER, state)
-    print("Base currency:", state["base_currency"])
-
-    # Optional rounding fix
+    if args.serve or args.http is not None:
+        serve(args)
+        return
+
+    options = Options(
+        fix_rounding_error=bool(args.fix_rounding_error),
+        group_by_ticker=bool(args.group_by_ticker),
+        jobs=args.jobs or 1,
+        filter_year=args.year is not None,
+        fifo=bool(args.fifo),
+        dividends=bool(args.dividends),
+        corporate_actions_file=args.corporate_actions,
+        verbose=True,
+    )
+    if args.year is None:
+        state = new_state(settings_taxpayer(), TAX_YEAR, options, (PERIOD_START, PERIOD_END))
+    else:
+        state = new_state(settings_taxpayer(), str(args.year), options)
+    if args.profile or args.profile_json or args.profile_memory:
+        state["profile"] = new_profile(trace_memory=args.profile_memory)
+        if args.profile_memory:
+            tracemalloc.start()
+    profiler = cProfile.Profile() if args.profile_stats else None
+    if profiler is not None:
+        profiler.enable()
+
+    # Load rate files and input CSV files (cached files are not parsed again)
+    with profile_stage(state, "load_rates") as stage:
+        load_rates(RATE_FOLDER, state)
+        stage["rows"] = len(state["rates"]["index"] or state["rates"]["tables"])
+        stage["rate_cache"] = "hit" if state["rates"]["index"] else "miss"
+    if state["profile"] is not None:
+        # Quoted days for the FX counters, read outside the timed stages
+        state["profile"]["quote_days"] = quote_days(state["rates"])
+    if args.import_trades and args.dividends:
+        raise ValueError("--dividends needs the input CSV files (a trades file has no dividends).")
+    if args.export_trades:
+        # Before loading: the export keeps rows that --year would drop while reading
+        state["trades_export"] = new_trade_columns()
+    actions_file = args.corporate_actions or (CORPORATE_ACTIONS_FILE if os.path.isfile(CORPORATE_ACTIONS_FILE) else None)
+    if actions_file and not args.import_trades:
+        load_corporate_actions(actions_file, state)
+        print(f"Corporate actions: {state['corporate_actions']['count']} ({actions_file})")
+    if args.import_trades:
+        with profile_stage(state, "load_trades_file") as stage:
+            load_trades_file(args.import_trades, state)
+            stage["rows"] = state["trades"]["rows"]
+    else:
+        if args.cache:
+            state["cache"] = open_input_cache(INPUT_CACHE_FILE, state["rates"], state["corporate_actions"])
+        with profile_stage(state, "load_input_files") as stage:
+            load_input_files(INPUT_FOLDER, state)
+            stage["rows"] = state["rows_scanned"]
+            stage["cached_files"] = len(state["cached_files"])
+    base_currencies = sorted(set(state["base_currencies"].values()))
+    print("Base currency:", ", ".join(base_currencies))
+
+    # Optional rounding fix (applied while building XML)
     if state["fix_rounding_error"]:
         print("Rounding fix: ENABLED")
-        apply_rounding_reconciliation(state)
     else:
         print("Rounding fix: DISABLED (use --fix-rounding-error to enable)")
 
-    # Build XML and write file
-    envelope, count = process_transactions(state)
-    xml_output = prettify(envelope)
-    output_path = save_file(xml_output, OUTPUT_FOLDER, OUTPUT_FILENAME)
+    # Build XML and write file (CSV rows are parsed and converted while building)
+    with profile_stage(state, "process_transactions") as stage:
+        envelope, count, adjustments = process_transactions(state)
+        stage["rows"] = count
+    if state["fix_rounding_error"]:
+        print_rounding_report(adjustments)
+    with profile_stage(state, "save_file") as stage:
+        output_path = save_file(prettify(envelope), OUTPUT_FOLDER, OUTPUT_FILENAME)
+        stage["bytes"] = os.path.getsize(output_path)
+    if args.export_trades:
+        with profile_stage(state, "write_trades_file") as stage:
+            write_trades_file(args.export_trades, state["trades_export"])
+            stage["rows"] = len(state["trades_export"]["columns"]["line"])
+        print("Trades saved to:", args.export_trades)
 
     print("Count:", count)
     print("XML saved to:", output_path)
+    if args.validate:
+        with profile_stage(state, "validate_xml"):
+            errors = validate_xml(output_path, load_schema(XSD_FOLDER, XSD_MAIN_FILE))
+        for message in errors:
+            print("[validate]", message)
+        print(f"[validate] {'XML is valid' if not errors else 'XML is NOT valid'} ({XSD_MAIN_FILE})")
+    if state["dividends"] is not None:
+        with profile_stage(state, "process_dividends") as stage:
+            dividends_envelope, dividend_count = process_dividends(state)
+            dividends_path = save_file(prettify(dividends_envelope), OUTPUT_FOLDER, DIVIDENDS_FILENAME)
+            stage["rows"] = dividend_count
+        print("Dividends:", dividend_count)
+        print("Dividend XML saved to:", dividends_path)
+    if state["fifo"] is not None:
+        with profile_stage(state, "write_fifo_report") as stage:
+            write_fifo_report(state["fifo"]["realized"], state["fifo"]["open_lots"], state["year"], OUTPUT_FOLDER)
+            stage["rows"] = len(state["fifo"]["realized"]) + len(state["fifo"]["open_lots"])
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile_stats)
+        print("cProfile stats saved to:", args.profile_stats)
+    if state["profile"] is not None:
+        print_profile(state["profile"])
+        if args.profile_json:
+            with open(args.profile_json, "w", encoding="utf-8") as f:
+                json.dump(profile_report(state["profile"]), f, indent=2)
+            print("Profile saved to:", args.profile_json)
 
 
 if __name__ == "__main__":